@@ -29,10 +29,13 @@ from utilities import (validate_remove_file,
                        determine_hostname,
                        modify_config_file)
 from collection_rules import InsightsConfig
-from data_collector import DataCollector
+from data_collector import DataCollector, InlineObfuscator
 from schedule import InsightsSchedule
-from connection import InsightsConnection
+from connection import InsightsConnection, shared_connection
 from archive import InsightsArchive
+from compressors import get_threads
+from retry import RetryPolicy
+from profiler import Profiler, PROFILE_MODES, DEFAULT_INTERVAL
 from support import InsightsSupport, registration_check
 from constants import InsightsConstants as constants
 from client_config import InsightsClient, set_up_options, parse_config_file
@@ -244,12 +247,28 @@ def handle_startup():
     # check registration before doing any uploads
     # Ignore if in offline mode
     if not InsightsClient.options.register and not InsightsClient.options.offline:
+        _prefetch_startup()
         msg, is_registered = _is_client_registered()
         if not is_registered:
             logger.error(msg)
             sys.exit(1)
 
 
+def _prefetch_startup():
+    '''
+    With prefetch_requests set, start the registration check, branch_info
+    and collection rules requests at once instead of one after the other
+    '''
+    if not InsightsClient.config.getboolean(APP_NAME, 'prefetch_requests'):
+        return
+    pconn = shared_connection()
+    pconn.prefetch(pconn.registration_url(), timeout=10)
+    pconn.prefetch(pconn.branch_info_url)
+    if (InsightsClient.options.update and not InsightsClient.options.just_upload and
+            not InsightsClient.options.from_file and not InsightsClient.options.from_stdin):
+        InsightsConfig(pconn).prefetch()
+
+
 def _is_client_registered():
     msg_notyet = 'This machine has not yet been registered.'
     msg_unreg = 'This machine has been unregistered.'
@@ -306,22 +325,37 @@ def handle_exception(exc_type, exc_value, exc_traceback):
         sys.exit('Caught unhandled exception, check log for more information')
 
 
-def trace_calls(frame, event, arg):
-    if event != 'call':
-        return
-    co = frame.f_code
-    func_name = co.co_name
-    if func_name == 'write':
-        return
-    func_line_no = frame.f_lineno
-    func_filename = co.co_filename
-    caller = frame.f_back
-    caller_line_no = caller.f_lineno
-    caller_filename = caller.f_code.co_filename
-    print 'Call to %s on line %s of %s from line %s of %s' % \
-        (func_name, func_line_no, func_filename,
-         caller_line_no, caller_filename)
-    return
+def _profile_interval():
+    '''
+    Seconds between the sampling profiler's samples
+    '''
+    try:
+        interval = InsightsClient.config.getfloat(APP_NAME, 'profile_interval')
+    except ValueError:
+        interval = None
+    if interval is None or interval <= 0:
+        logger.warn('WARNING: Invalid profile_interval, using %s', DEFAULT_INTERVAL)
+        return DEFAULT_INTERVAL
+    return interval
+
+
+def _profile_mode():
+    '''
+    Profiler mode from --profile or the profile setting, None when off
+    trace is the deprecated way of asking for the sampler
+    '''
+    mode = (InsightsClient.options.profile or
+            InsightsClient.config.get(APP_NAME, 'profile'))
+    if not mode and InsightsClient.config.getboolean(APP_NAME, 'trace'):
+        logger.warn('WARNING: trace is deprecated, use profile=sample instead')
+        mode = 'sample'
+    if not mode:
+        return None
+    if mode not in PROFILE_MODES:
+        logger.error('Unknown profile mode %s, valid modes are %s',
+                     mode, ', '.join(PROFILE_MODES))
+        return None
+    return mode
 
 
 def try_register():
@@ -369,7 +403,7 @@ def register():
         if save.lower() == 'y' or save.lower() == 'yes':
             logger.debug('Writing user/pass to config')
             modify_config_file({'username': username, 'password': password})
-    pconn = InsightsConnection()
+    pconn = shared_connection(renew=True)
     return pconn.register()
 
 
@@ -384,6 +418,47 @@ def _delete_archive(archive):
         archive.delete_archive_file()
 
 
+def _stream_archive():
+    '''
+    Whether to write the archive as data is collected, skipping the
+    staging directory
+    '''
+    if not InsightsClient.config.getboolean(APP_NAME, 'stream_archive'):
+        return False
+    if InsightsClient.options.no_tar_file:
+        logger.debug('Not streaming archive, --no-tar-file needs the archive directory')
+        return False
+    if (InsightsClient.config.getboolean(APP_NAME, 'obfuscate') and
+            not InsightsClient.config.getboolean(APP_NAME, 'inline_obfuscation')):
+        logger.debug('Not streaming archive, obfuscation needs the archive directory')
+        return False
+    return True
+
+
+def _inline_obfuscator(rm_conf, mountpoint):
+    '''
+    Obfuscator cleaning data on its way into the archive, if enabled
+    '''
+    if (InsightsClient.config.getboolean(APP_NAME, 'obfuscate') and
+            InsightsClient.config.getboolean(APP_NAME, 'inline_obfuscation')):
+        return InlineObfuscator(rm_conf, mountpoint)
+    return None
+
+
+def _compression_threads():
+    '''
+    Number of threads to compress the archive with
+    '''
+    threads = InsightsClient.options.compression_threads
+    if threads is None:
+        try:
+            threads = InsightsClient.config.getint(APP_NAME, 'compression_threads')
+        except ValueError:
+            logger.warn('WARNING: Invalid compression_threads, compressing single threaded')
+            threads = 1
+    return get_threads(threads)
+
+
 def _create_metadata_json(archives):
     metadata = {'display_name': archives[-1]['display_name'],
                 'product': 'Docker',
@@ -452,7 +527,7 @@ def collect_data_and_upload(rc=0):
         pconn = None
         branch_info = constants.default_branch_info
     else:
-        pconn = InsightsConnection()
+        pconn = shared_connection()
 
     # TODO: change these err msgs to be more meaningful , i.e.
     # "could not determine login information"
@@ -496,9 +571,9 @@ def collect_data_and_upload(rc=0):
                      ('--from-file' if InsightsClient.options.from_file else '--from-stdin'))
         sys.exit(1)
 
-    start = time.clock()
+    start = time.time()
     collection_rules, rm_conf = pc.get_conf(InsightsClient.options.update, stdin_config)
-    collection_elapsed = (time.clock() - start)
+    collection_elapsed = (time.time() - start)
     logger.debug("Rules configuration loaded. Elapsed time: %s", collection_elapsed)
 
     individual_archives = []
@@ -551,9 +626,12 @@ def collect_data_and_upload(rc=0):
             archive_meta['product'] = 'Docker'
             archive_meta['system_id'] = generate_analysis_target_id(t['type'], t['name'])
 
-            collection_start = time.clock()
+            collection_start = time.time()
             archive = InsightsArchive(compressor=InsightsClient.options.compressor if not InsightsClient.options.container_mode else "none",
-                                      target_name=t['name'])
+                                      target_name=t['name'],
+                                      stream=_stream_archive(),
+                                      threads=_compression_threads(),
+                                      obfuscator=_inline_obfuscator(rm_conf, mp))
             atexit.register(_delete_archive, archive)
             dc = DataCollector(archive,
                                InsightsClient.config,
@@ -563,13 +641,13 @@ def collect_data_and_upload(rc=0):
 
             logger.info('Starting to collect Insights data for %s', logging_name)
             dc.run_collection(collection_rules, rm_conf, branch_info)
-            elapsed = (time.clock() - start)
+            elapsed = (time.time() - collection_start)
             logger.debug("Data collection complete. Elapsed time: %s", elapsed)
 
             obfuscate = InsightsClient.config.getboolean(APP_NAME, "obfuscate")
 
             # include rule refresh time in the duration
-            collection_duration = (time.clock() - collection_start) + collection_elapsed
+            collection_duration = (time.time() - collection_start) + collection_elapsed
 
             # add custom metadata about a host if provided by from_file
             # use in the OSE case
@@ -630,33 +708,55 @@ def collect_data_and_upload(rc=0):
 def _do_upload(pconn, tar_file, logging_name, collection_duration, rc=0):
     # do the upload
     logger.info('Uploading Insights data for %s, this may take a few minutes', logging_name)
-    for tries in range(InsightsClient.options.retries):
-        upload = pconn.upload_archive(tar_file, collection_duration,
-                                      cluster=generate_machine_id(
-                                          docker_group=InsightsClient.options.container_mode))
-        if upload.status_code == 201:
-            write_lastupload_file()
-            machine_id = generate_machine_id()
+    policy = RetryPolicy.from_config(InsightsClient.config, InsightsClient.options.retries)
+    pconn.slot = pconn.upload_slot()
+    try:
+        for tries in range(InsightsClient.options.retries):
             try:
-                logger.info("You successfully uploaded a report from %s to account %s." % (machine_id, InsightsClient.account_number))
-            except:
-                pass
-            logger.info("Upload completed successfully!")
-            break
-        elif upload.status_code == 412:
-            pconn.handle_fail_rcs(upload)
-        else:
-            logger.error("Upload attempt %d of %d failed! Status Code: %s",
-                         tries + 1, InsightsClient.options.retries, upload.status_code)
-            if tries + 1 != InsightsClient.options.retries:
-                logger.info("Waiting %d seconds then retrying",
-                            constants.sleep_time)
-                time.sleep(constants.sleep_time)
+                upload = pconn.upload_archive(tar_file, collection_duration,
+                                              cluster=generate_machine_id(
+                                                  docker_group=InsightsClient.options.container_mode))
+                status_code = upload.status_code
+            except requests.exceptions.RequestException as err:
+                # a chunked upload resumes where this one was cut off
+                logger.error("Upload attempt %d of %d failed: %s",
+                             tries + 1, InsightsClient.options.retries, err)
+                upload = None
+                status_code = None
+            if status_code == 201:
+                write_lastupload_file()
+                machine_id = generate_machine_id()
+                try:
+                    logger.info("You successfully uploaded a report from %s to account %s." % (machine_id, InsightsClient.account_number))
+                except:
+                    pass
+                logger.info("Upload completed successfully!")
+                break
+            elif status_code == 412:
+                pconn.handle_fail_rcs(upload)
             else:
-                logger.error("All attempts to upload have failed!")
-                logger.error("Please see %s for additional information",
-                             constants.default_log_file)
-                rc = 1
+                if upload is not None:
+                    logger.error("Upload attempt %d of %d failed! Status Code: %s",
+                                 tries + 1, InsightsClient.options.retries, status_code)
+                if not policy.retryable(upload):
+                    pconn.handle_fail_rcs(upload)
+                    logger.error("Upload failed with a status retrying won't change, "
+                                 "not retrying")
+                    rc = 1
+                    break
+                if tries + 1 != InsightsClient.options.retries:
+                    delay = policy.delay(tries, upload)
+                    logger.info("Waiting %d seconds then retrying", delay)
+                    time.sleep(delay)
+                else:
+                    logger.error("All attempts to upload have failed!")
+                    logger.error("Please see %s for additional information",
+                                 constants.default_log_file)
+                    rc = 1
+    finally:
+        if pconn.slot is not None:
+            pconn.release_upload_slot(pconn.slot)
+            pconn.slot = None
     return rc
 
 
@@ -696,8 +796,11 @@ def _main():
     InsightsClient.argv = sys.argv
     handler = set_up_logging()
 
-    if InsightsClient.config.getboolean(APP_NAME, 'trace'):
-        sys.settrace(trace_calls)
+    profile_mode = _profile_mode()
+    if profile_mode:
+        profiler = Profiler(profile_mode, interval=_profile_interval())
+        profiler.start()
+        atexit.register(profiler.stop)
 
     # Defer logging till it's ready
     logger.debug('invoked with args: %s', InsightsClient.options)
@@ -8,9 +8,13 @@ import shutil
 import subprocess
 import shlex
 import logging
-from utilities import determine_hostname, _expand_paths, write_data_to_file
+import tarfile
+from io import BytesIO
+from utilities import (determine_hostname, _expand_paths, write_data_to_file,
+                       copy_data_to_file)
 from constants import InsightsConstants as constants
-from insights_spec import InsightsFile, InsightsCommand
+from insights_spec import InsightsFile, InsightsCommand, RawFile
+from compressors import get_compressor
 
 logger = logging.getLogger(constants.app_name)
 
@@ -22,20 +26,39 @@ class InsightsArchive(object):
     and files to the insights archive
     """
 
-    def __init__(self, compressor="gz", target_name=None):
+    def __init__(self, compressor="gz", target_name=None, stream=False, threads=1,
+                 obfuscator=None):
         """
         Initialize the Insights Archive
         Create temp dir, archive dir, and command dir
+        With stream, open the tar file instead and write everything
+        straight into it, without any staging directories
+        threads is how many threads the compressor may use
+        obfuscator, if given, cleans everything before it is written
         """
-        self.tmp_dir = tempfile.mkdtemp(prefix='/var/tmp/')
+        self.tmp_dir = None if stream else tempfile.mkdtemp(prefix='/var/tmp/')
         self.archive_tmp_dir = tempfile.mkdtemp(prefix='/var/tmp/')
         name = determine_hostname(target_name)
+        self.obfuscator = obfuscator
+        if obfuscator:
+            # obfuscation reports are kept next to the tar file
+            obfuscator.start(self.archive_tmp_dir)
+            name = obfuscator.archive_hostname(name)
         self.archive_name = ("insights-%s-%s" %
                              (name,
                               time.strftime("%Y%m%d%H%M%S")))
-        self.archive_dir = self.create_archive_dir()
-        self.cmd_dir = self.create_command_dir()
         self.compressor = compressor
+        self.threads = threads
+        self.backend = get_compressor(compressor, threads)
+        self.tar_stream = None
+        if stream:
+            self.archive_dir = None
+            self.cmd_dir = None
+            self.tar_stream = TarStream(self.get_tar_file_name(), self.backend, threads)
+            self.tar_stream.add_dir(os.path.join(self.archive_name, 'insights_commands'))
+        else:
+            self.archive_dir = self.create_archive_dir()
+            self.cmd_dir = self.create_command_dir()
 
     def create_archive_dir(self):
         """
@@ -102,38 +125,59 @@ class InsightsArchive(object):
                 logger.debug("Not a directory: %s", directory)
         return path
 
-    def get_compression_flag(self, compressor):
-        return {
-            "gz": "z",
-            "xz": "J",
-            "bz2": "j",
-            "none": ""
-        }.get(compressor, "z")
+    def get_tar_file_name(self):
+        tar_file_name = os.path.join(self.archive_tmp_dir, self.archive_name)
+        return tar_file_name + ".tar" + self.backend.ext
 
     def create_tar_file(self, full_archive=False):
         """
         Create tar file to be compressed
         """
-        tar_file_name = os.path.join(self.archive_tmp_dir, self.archive_name)
-        ext = "" if self.compressor == "none" else ".%s" % self.compressor
-        tar_file_name = tar_file_name + ".tar" + ext
+        tar_file_name = self.get_tar_file_name()
         logger.debug("Tar File: " + tar_file_name)
-        subprocess.call(shlex.split("tar c%sfS %s -C %s ." % (
-            self.get_compression_flag(self.compressor),
-            tar_file_name,
-            # for the docker "uber archive,"use archive_dir
-            #   rather than tmp_dir for all the files we tar,
-            #   because all the individual archives are in there
-            self.tmp_dir if not full_archive else self.archive_dir)),
-            stderr=subprocess.PIPE)
+        if self.tar_stream:
+            self.tar_stream.close()
+            logger.debug("Tar File Size: %s", str(os.path.getsize(tar_file_name)))
+            return tar_file_name
+        # for the docker "uber archive,"use archive_dir
+        #   rather than tmp_dir for all the files we tar,
+        #   because all the individual archives are in there
+        source_dir = self.tmp_dir if not full_archive else self.archive_dir
+        if self.backend.is_builtin(self.threads):
+            subprocess.call(shlex.split("tar c%sfS %s -C %s ." % (
+                self.backend.tar_flag,
+                tar_file_name,
+                source_dir)),
+                stderr=subprocess.PIPE)
+        else:
+            self._compress_tar(tar_file_name, source_dir)
         self.delete_archive_dir()
         logger.debug("Tar File Size: %s", str(os.path.getsize(tar_file_name)))
         return tar_file_name
 
+    def _compress_tar(self, tar_file_name, source_dir):
+        """
+        Pipe tar through the compression program
+        """
+        command = self.backend.command(self.threads)
+        logger.debug("Compressing with: %s", ' '.join(command))
+        with open(os.devnull, 'w') as devnull:
+            with open(tar_file_name, 'wb') as tar_file:
+                tar = subprocess.Popen(['tar', 'cfS', '-', '-C', source_dir, '.'],
+                                       stdout=subprocess.PIPE, stderr=devnull,
+                                       close_fds=True)
+                compress = subprocess.Popen(command, stdin=tar.stdout,
+                                            stdout=tar_file, close_fds=True)
+                tar.stdout.close()
+                compress.wait()
+                tar.wait()
+
     def delete_tmp_dir(self):
         """
         Delete the entire tmp dir
         """
+        if self.tmp_dir is None:
+            return
         logger.debug("Deleting: " + self.tmp_dir)
         shutil.rmtree(self.tmp_dir, True)
 
@@ -141,6 +185,8 @@ class InsightsArchive(object):
         """
         Delete the entire archive dir
         """
+        if self.archive_dir is None:
+            return
         logger.debug("Deleting: " + self.archive_dir)
         shutil.rmtree(self.archive_dir, True)
 
@@ -156,21 +202,131 @@ class InsightsArchive(object):
         Add files and commands to archive
         Use InsightsSpec.get_output() to get data
         '''
+        self.write_spec_output(spec, spec.get_output())
+
+    def write_spec_output(self, spec, output):
+        '''
+        Write output already gathered from a spec to the archive
+        '''
         if spec.archive_path:
-            archive_path = self.get_full_archive_path(spec.archive_path.lstrip('/'))
+            archive_path = spec.archive_path
         else:
             # should never get here if the spec is correct
             if isinstance(spec, InsightsCommand):
-                archive_path = os.path.join(self.cmd_dir, spec.mangled_command.lstrip('/'))
+                archive_path = os.path.join('insights_commands', spec.mangled_command.lstrip('/'))
             if isinstance(spec, InsightsFile):
-                archive_path = self.get_full_archive_path(spec.relative_path.lstrip('/'))
-        output = spec.get_output()
-        if output:
-            write_data_to_file(output, archive_path)
+                archive_path = spec.relative_path
+        if isinstance(output, RawFile):
+            self.copy_to_archive(output, archive_path)
+        elif output:
+            self.write_to_archive(output, archive_path)
 
     def add_metadata_to_archive(self, metadata, meta_path):
         '''
         Add metadata to archive
         '''
-        archive_path = self.get_full_archive_path(meta_path.lstrip('/'))
-        write_data_to_file(metadata, archive_path)
+        self.write_to_archive(metadata, meta_path)
+
+    def write_to_archive(self, data, path):
+        '''
+        Write data to a path relative to the archive root
+        '''
+        if self.obfuscator:
+            data = self.obfuscator.clean(data)
+        if self.tar_stream:
+            self.tar_stream.add_data(
+                data, os.path.join(self.archive_name, path.lstrip('/')))
+        else:
+            write_data_to_file(data, self.get_full_archive_path(path))
+
+    def copy_to_archive(self, raw, path):
+        '''
+        Copy a RawFile to a path relative to the archive root
+        '''
+        try:
+            if self.tar_stream:
+                self.tar_stream.add_file(
+                    raw.spool, raw.size, os.path.join(self.archive_name, path.lstrip('/')))
+            else:
+                copy_data_to_file(raw.spool, self.get_full_archive_path(path))
+        finally:
+            raw.close()
+
+
+class TarStream(object):
+    '''
+    Tar file written member by member as data is collected
+    Members are laid out as tar would lay out the staging directory:
+    ./<archive_name>/...
+    '''
+    def __init__(self, path, compressor, threads=1):
+        self.path = path
+        self.dirs = set()
+        self.proc = None
+        # modes the staging files and directories would have had
+        umask = os.umask(0)
+        os.umask(umask)
+        self.file_mode = 0o666 & ~umask
+        self.dir_mode = 0o700
+        self.fileobj = open(path, 'wb')
+        if compressor.tarfile_mode is not None and compressor.is_builtin(threads):
+            self.tar = tarfile.open(mode='w|' + compressor.tarfile_mode,
+                                    fileobj=self.fileobj)
+        else:
+            command = compressor.command(threads)
+            logger.debug("Compressing with: %s", ' '.join(command))
+            self.proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                         stdout=self.fileobj, close_fds=True)
+            self.tar = tarfile.open(mode='w|', fileobj=self.proc.stdin)
+        logger.debug("Streaming archive to %s", path)
+        self.add_dir('')
+
+    def _tarinfo(self, name, mode):
+        info = tarfile.TarInfo('./' + name if name else '.')
+        info.mode = mode
+        info.mtime = time.time()
+        info.uid = os.getuid()
+        info.gid = os.getgid()
+        return info
+
+    def add_dir(self, name):
+        '''
+        Add a directory and any missing parents
+        '''
+        name = name.strip('/')
+        if name in self.dirs:
+            return
+        if name:
+            self.add_dir(os.path.dirname(name))
+        info = self._tarinfo(name, self.dir_mode)
+        info.type = tarfile.DIRTYPE
+        self.tar.addfile(info)
+        self.dirs.add(name)
+
+    def add_data(self, data, name):
+        '''
+        Add a file holding data
+        '''
+        name = name.strip('/')
+        self.add_dir(os.path.dirname(name))
+        data = data.encode('utf8')
+        info = self._tarinfo(name, self.file_mode)
+        info.size = len(data)
+        self.tar.addfile(info, BytesIO(data))
+
+    def add_file(self, fileobj, size, name):
+        '''
+        Add a file holding the size bytes read from fileobj
+        '''
+        name = name.strip('/')
+        self.add_dir(os.path.dirname(name))
+        info = self._tarinfo(name, self.file_mode)
+        info.size = size
+        self.tar.addfile(info, fileobj)
+
+    def close(self):
+        self.tar.close()
+        if self.proc:
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.fileobj.close()
@@ -0,0 +1,152 @@
+"""
+Chunked, resumable archive uploads
+
+The archive is sent in fixed size chunks within an upload session:
+
+  POST <url>/chunked                  {"name", "size", "sha256", "chunk_size",
+                                       "content_type"}
+                                      -> 201 {"session": "<id>"}
+  GET  <url>/chunked/<id>             -> 200 {"chunks": [<received chunk>, ...]}
+                                         404 once the session is gone
+  PUT  <url>/chunked/<id>/<n>         bytes n * chunk_size onwards
+                                      Content-Range: bytes <first>-<last>/<size>
+                                      -> 204
+  POST <url>/chunked/<id>/complete    -> 201, as for a single upload
+
+The session is remembered next to the archive, so a retried upload only
+sends the chunks the server has not received yet.
+"""
+import os
+import json
+import hashlib
+import logging
+from constants import InsightsConstants as constants
+from workers import WorkerPool
+
+logger = logging.getLogger(constants.app_name)
+
+# statuses of a server that doesn't do chunked uploads
+UNSUPPORTED = (404, 405, 501)
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ChunkedUpload(object):
+    '''
+    Upload of one archive to url in chunk_size chunks,
+    parallelism chunks at a time
+    '''
+    def __init__(self, session, url, path, chunk_size, parallelism=1,
+                 content_type='application/octet-stream', headers=None):
+        self.session = session
+        self.url = url.rstrip('/') + '/chunked'
+        self.path = path
+        self.chunk_size = chunk_size
+        self.parallelism = parallelism
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.size = os.path.getsize(path)
+        self.sha256 = _sha256(path)
+        self.state_file = path + '.upload'
+        # whether the server took up a session
+        self.started = False
+
+    def _load_session(self):
+        '''
+        URL of the session a previous attempt started for this archive
+        '''
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if (state.get('upload_url') != self.url or
+                state.get('sha256') != self.sha256 or
+                state.get('chunk_size') != self.chunk_size):
+            return None
+        return state.get('session_url')
+
+    def _save_session(self, session_url):
+        with os.fdopen(os.open(self.state_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                               int('0600', 8)), 'w') as f:
+            json.dump({'upload_url': self.url,
+                       'session_url': session_url,
+                       'sha256': self.sha256,
+                       'chunk_size': self.chunk_size}, f)
+
+    def _forget_session(self):
+        try:
+            os.remove(self.state_file)
+        except OSError:
+            pass
+
+    def _start(self):
+        '''
+        (session URL, chunks the server already has), or the response
+        refusing to start a session
+        '''
+        session_url = self._load_session()
+        if session_url:
+            status = self.session.get(session_url)
+            if status.status_code == 200:
+                received = set(status.json().get('chunks', []))
+                logger.debug('Resuming upload session %s, %d chunks received',
+                             session_url, len(received))
+                return session_url, received, None
+            logger.debug('Upload session %s is gone: %s', session_url, status.status_code)
+            self._forget_session()
+        headers = dict(self.headers)
+        headers['Content-Type'] = 'application/json'
+        start = self.session.post(self.url, headers=headers,
+                                  data=json.dumps({'name': os.path.basename(self.path),
+                                                   'size': self.size,
+                                                   'sha256': self.sha256,
+                                                   'chunk_size': self.chunk_size,
+                                                   'content_type': self.content_type}))
+        if start.status_code != 201:
+            return None, None, start
+        session_url = self.url + '/' + start.json()['session']
+        self._save_session(session_url)
+        logger.debug('Started upload session %s', session_url)
+        return session_url, set(), None
+
+    def _send_chunk(self, session_url, number):
+        first = number * self.chunk_size
+        with open(self.path, 'rb') as f:
+            f.seek(first)
+            data = f.read(self.chunk_size)
+        headers = {'Content-Type': 'application/octet-stream',
+                   'Content-Range': 'bytes %d-%d/%d' % (first, first + len(data) - 1,
+                                                        self.size)}
+        return self.session.put('%s/%d' % (session_url, number),
+                                data=data, headers=headers)
+
+    def upload(self):
+        '''
+        Upload the archive, returning the response completing the
+        session, or the first response that failed
+        '''
+        session_url, received, failed = self._start()
+        if failed is not None:
+            return failed
+        self.started = True
+        chunks = max(1, (self.size + self.chunk_size - 1) // self.chunk_size)
+        missing = [n for n in range(chunks) if n not in received]
+        logger.debug('Uploading %d of %d chunks of %s', len(missing), chunks, self.path)
+        pool = WorkerPool(self.parallelism)
+        responses = pool.imap(lambda n: self._send_chunk(session_url, n), missing)
+        for response in responses:
+            if response.status_code not in (200, 204):
+                responses.close()
+                return response
+        complete = self.session.post(session_url + '/complete', headers=self.headers)
+        if complete.status_code in (201, 404):
+            # done, or the session is gone and has to start over
+            self._forget_session()
+        return complete
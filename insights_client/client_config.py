@@ -48,8 +48,8 @@ def set_up_options(parser):
     parser.add_option('--retry',
                       action="store",
                       type="int",
-                      help=('Number of times to retry uploading. '
-                            '%s seconds between tries'
+                      help=('Number of times to try uploading, waiting '
+                            'a random time of up to %s seconds between tries'
                             % constants.sleep_time),
                       default=1,
                       dest="retries")
@@ -90,9 +90,37 @@ def set_up_options(parser):
                       action='store_true')
     parser.add_option('--compressor',
                       help='specify alternate compression '
-                           'algorithm (gz, bzip2, xz, none; defaults to gz)',
+                           'algorithm (gz, bz2, xz, zstd, none; defaults to gz)',
                       dest='compressor',
                       default='gz')
+    parser.add_option('--compression-threads',
+                      help='number of threads to compress the archive with, '
+                           '0 for one per CPU; overrides compression_threads '
+                           'in the config file',
+                      action='store',
+                      type='int',
+                      dest='compression_threads',
+                      default=None)
+    parser.add_option('--workers',
+                      help='number of specs to collect concurrently; '
+                           'overrides collection_workers in the config file',
+                      action='store',
+                      type='int',
+                      dest='workers',
+                      default=None)
+    parser.add_option('--profile',
+                      help='profile the run with cprofile or sample, '
+                           'writing the profile to ' + constants.log_dir +
+                           '; overrides profile in the config file',
+                      action='store',
+                      dest='profile',
+                      default=None)
+    parser.add_option('--profile-collection',
+                      help='show the time and resources each command and '
+                           'file took to collect',
+                      action='store_true',
+                      dest='profile_collection',
+                      default=False)
     parser.add_option('--from-stdin',
                       help='take configuration from stdin',
                       dest='from_stdin', action='store_true',
@@ -213,6 +241,8 @@ def parse_config_file(conf_file):
     parsedconfig = ConfigParser.RawConfigParser(
         {'loglevel': constants.log_level,
          'trace': 'False',
+         'profile': '',
+         'profile_interval': '0.01',
          'app_name': constants.app_name,
          'auto_config': 'True',
          'authmethod': constants.auth_method,
@@ -232,8 +262,31 @@ def parse_config_file(conf_file):
          'proxy': None,
          'insecure_connection': 'False',
          'no_schedule': 'False',
+         'schedule_window': '0',
+         'schedule_start': '03:00',
+         'schedule_jitter': '0',
          'docker_image_name': '',
-         'display_name': None})
+         'display_name': None,
+         'collection_workers': '1',
+         'stream_archive': 'False',
+         'compression_threads': '1',
+         'obfuscation_workers': '1',
+         'inline_obfuscation': 'False',
+         'pre_command_cache_ttl': '0',
+         'raw_copy_paths': '',
+         'spec_output_limit': '0',
+         'collection_output_limit': '0',
+         'command_nice': '0',
+         'command_ionice_class': '',
+         'command_ionice_priority': '7',
+         'command_memory_limit': '0',
+         'upload_chunk_size': '0',
+         'upload_parallelism': '1',
+         'upload_slot_wait': '0',
+         'request_retries': '1',
+         'prefetch_requests': 'False',
+         'retry_base_delay': '30',
+         'retry_max_delay': str(constants.sleep_time)})
     try:
         parsedconfig.read(conf_file)
     except ConfigParser.Error:
@@ -0,0 +1,111 @@
+"""
+Collection plans, the specs of the collection rules to run for a target
+"""
+import os
+import json
+import hashlib
+import logging
+from constants import InsightsConstants as constants
+
+logger = logging.getLogger(constants.app_name)
+
+
+def plan_key(conf, rm_conf):
+    '''
+    Key of every plan made from these collection rules and remove.conf
+    '''
+    removed = hashlib.sha256(json.dumps(rm_conf, sort_keys=True)).hexdigest()
+    return '%s:%s:%s:%s' % (constants.version, conf.get('file'),
+                            conf.get('version'), removed)
+
+
+class CollectionPlan(object):
+    '''
+    The file, glob and command specs to run for one target type,
+    in the order of the collection rules, with the files and commands
+    listed in remove.conf already left out
+    entries is a list of (kind, spec), skipped a list of (kind, name)
+    Globs are only expanded when run, so removed_files still has to be
+    checked for the files they match
+    '''
+    def __init__(self, entries, skipped, removed_files):
+        self.entries = entries
+        self.skipped = skipped
+        self.removed_files = set(removed_files)
+
+    @classmethod
+    def build(cls, conf, rm_conf, target_type):
+        removed_files = set()
+        removed_commands = set()
+        if rm_conf:
+            removed_files.update(rm_conf.get('files', []))
+            removed_commands.update(rm_conf.get('commands', []))
+        entries = []
+        skipped = []
+        for specname in conf['specs']:
+            try:
+                spec_list = conf['specs'][specname][target_type]
+            except LookupError:
+                logger.debug('Target type %s not found in spec %s. Skipping...',
+                             target_type, specname)
+                continue
+            for spec in spec_list:
+                if 'file' in spec:
+                    if spec['file'] in removed_files:
+                        skipped.append(('file', spec['file']))
+                    else:
+                        entries.append(('file', spec))
+                elif 'glob' in spec:
+                    entries.append(('glob', spec))
+                elif 'command' in spec:
+                    if spec['command'] in removed_commands:
+                        skipped.append(('command', spec['command']))
+                    else:
+                        entries.append(('command', spec))
+        return cls(entries, skipped, removed_files)
+
+    def to_json(self):
+        return {'entries': self.entries,
+                'skipped': self.skipped,
+                'removed_files': sorted(self.removed_files)}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls([tuple(entry) for entry in data['entries']],
+                   [tuple(skip) for skip in data['skipped']],
+                   data['removed_files'])
+
+
+def _load_plans(path, key):
+    try:
+        with open(path, 'r') as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if cached.get('key') != key:
+        return {}
+    return cached.get('plans', {})
+
+
+def get_plan(conf, rm_conf, target_type, path=constants.collection_plan_file):
+    '''
+    The plan for target_type, from the plan cache when the collection
+    rules and remove.conf haven't changed since it was made
+    '''
+    key = plan_key(conf, rm_conf)
+    plans = _load_plans(path, key)
+    if target_type in plans:
+        try:
+            logger.debug('Using cached collection plan for %s', target_type)
+            return CollectionPlan.from_json(plans[target_type])
+        except (LookupError, TypeError, ValueError):
+            logger.debug('Invalid cached collection plan for %s', target_type)
+    plan = CollectionPlan.build(conf, rm_conf, target_type)
+    plans[target_type] = plan.to_json()
+    try:
+        with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                               int('0600', 8)), 'w') as f:
+            json.dump({'key': key, 'plans': plans}, f)
+    except (IOError, OSError) as err:
+        logger.debug('Could not cache collection plan in %s: %s', path, err)
+    return plan
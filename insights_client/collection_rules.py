@@ -7,6 +7,7 @@ import sys
 import six
 import shlex
 import os
+import hashlib
 from subprocess import Popen, PIPE, STDOUT
 from tempfile import NamedTemporaryFile
 from constants import InsightsConstants as constants
@@ -14,6 +15,8 @@ from client_config import InsightsClient
 
 APP_NAME = constants.app_name
 logger = logging.getLogger(APP_NAME)
+# verified digests to remember, enough for the cache, fallback and stdin rules
+GPG_VERIFIED_KEEP = 8
 
 
 class InsightsConfig(object):
@@ -28,6 +31,8 @@ class InsightsConfig(object):
         self.fallback_file = constants.collection_fallback_file
         self.remove_file = constants.collection_remove_file
         self.collection_rules_file = constants.collection_rules_file
+        self.validators_file = constants.collection_rules_validators_file
+        self.gpg_verified_file = constants.gpg_verified_file
         protocol = "https://"
         insecure_connection = InsightsClient.config.getboolean(APP_NAME, "insecure_connection")
         if insecure_connection:
@@ -40,13 +45,48 @@ class InsightsConfig(object):
         self.gpg = InsightsClient.config.getboolean(APP_NAME, 'gpg')
         self.conn = conn
 
+    def _gpg_digest(self, path, sig):
+        """
+        Digest of everything a signature check depends on,
+        None if any of it can't be read
+        """
+        digests = [self._file_sha256(f) for f in (path, sig, constants.pub_gpg_path)]
+        if None in digests:
+            return None
+        return hashlib.sha256(' '.join(digests)).hexdigest()
+
+    def _load_gpg_verified(self):
+        try:
+            with open(self.gpg_verified_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return []
+
+    def _save_gpg_verified(self, digest):
+        """
+        Remember a verified digest, keeping the most recent few
+        """
+        verified = [d for d in self._load_gpg_verified() if d != digest]
+        verified.append(digest)
+        try:
+            self.write_collection_data(self.gpg_verified_file,
+                                       json.dumps(verified[-GPG_VERIFIED_KEEP:]))
+        except (IOError, OSError) as err:
+            logger.debug("Could not cache GPG verification: %s", err)
+
     def validate_gpg_sig(self, path, sig=None):
         """
         Validate the collection rules
+        Skips gpg when this rules file, signature and keyring
+        have been verified before
         """
         logger.debug("Verifying GPG signature of Insights configuration")
         if sig is None:
             sig = path + ".asc"
+        digest = self._gpg_digest(path, sig)
+        if digest is not None and digest in self._load_gpg_verified():
+            logger.debug("GPG signature previously verified")
+            return True
         command = ("/usr/bin/gpg --no-default-keyring "
                    "--keyring " + constants.pub_gpg_path +
                    " --verify " + sig + " " + path)
@@ -64,6 +104,8 @@ class InsightsConfig(object):
             sys.exit("ERROR: Unable to validate GPG signature! Exiting!")
         else:
             logger.debug("GPG signature verified")
+            if digest is not None:
+                self._save_gpg_verified(digest)
             return True
 
     def try_disk(self, path, gpg=True):
@@ -87,17 +129,95 @@ class InsightsConfig(object):
                 logger.warn("WARNING: %s was an empty file", path)
                 return
 
+    def _file_sha256(self, path):
+        """
+        sha256 of a file, None if it can't be read
+        """
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except IOError:
+            return None
+
+    def load_validators(self):
+        """
+        Validators of the cached collection rules, None unless the cache
+        is still the copy they were recorded for, verified if gpg is on
+        """
+        try:
+            with open(self.validators_file, 'r') as f:
+                validators = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if validators.get('url') != self.collection_rules_url:
+            return None
+        if self.gpg and not validators.get('gpg'):
+            return None
+        if validators.get('sha256') != self._file_sha256(self.collection_rules_file):
+            return None
+        if self.gpg and (validators.get('sig_sha256') !=
+                         self._file_sha256(self.collection_rules_file + '.asc')):
+            return None
+        return validators
+
+    def save_validators(self, req):
+        """
+        Record the validators of freshly downloaded collection rules
+        """
+        validators = {'url': self.collection_rules_url,
+                      'etag': req.headers.get('etag'),
+                      'last_modified': req.headers.get('last-modified'),
+                      'sha256': self._file_sha256(self.collection_rules_file),
+                      'gpg': self.gpg}
+        if self.gpg:
+            validators['sig_sha256'] = self._file_sha256(self.collection_rules_file + '.asc')
+        self.write_collection_data(self.validators_file, json.dumps(validators))
+
+    def _rules_headers(self, validators):
+        headers = {'accept': 'text/plain'}
+        if validators:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def prefetch(self):
+        '''
+        Start downloading the collection rules, and their signature unless
+        there's a cached copy they'll likely turn out unchanged from
+        '''
+        validators = self.load_validators()
+        self.conn.prefetch(self.collection_rules_url, headers=self._rules_headers(validators))
+        if self.gpg and not validators:
+            self.conn.prefetch(self.collection_rules_url + '.asc',
+                               headers={'accept': 'text/plain'})
+
     def get_collection_rules(self, raw=False):
         """
         Download the collection rules
+        Asks only for rules newer than the cached copy, and reuses
+        the cached copy without verifying it again if there are none
         """
         logger.debug("Attemping to download collection rules from %s",
                      self.collection_rules_url)
 
-        req = self.conn.session.get(
-            self.collection_rules_url, headers=({'accept': 'text/plain'}))
+        validators = self.load_validators()
+        headers = self._rules_headers(validators)
+        req = self.conn.retry_policy.call(
+            lambda: self.conn.get(self.collection_rules_url, headers=headers),
+            'collection rules download')
 
-        if req.status_code == 200:
+        if req.status_code == 304 and validators:
+            logger.debug("Collection rules not modified, using %s",
+                         self.collection_rules_file)
+            with open(self.collection_rules_file, 'r') as f:
+                rules = f.read()
+            if raw:
+                return rules
+            else:
+                return json.loads(rules)
+        elif req.status_code == 200:
             logger.debug("Successfully downloaded collection rules")
 
             json_response = NamedTemporaryFile()
@@ -113,6 +233,7 @@ class InsightsConfig(object):
             self.get_collection_rules_gpg(json_response)
 
         self.write_collection_data(self.collection_rules_file, req.text)
+        self.save_validators(req)
 
         if raw:
             return req.text
@@ -125,8 +246,9 @@ class InsightsConfig(object):
                      self.collection_rules_url + ".asc")
 
         headers = ({'accept': 'text/plain'})
-        config_sig = self.conn.session.get(self.collection_rules_url + '.asc',
-                                           headers=headers)
+        config_sig = self.conn.retry_policy.call(
+            lambda: self.conn.get(self.collection_rules_url + '.asc', headers=headers),
+            'collection rules signature download')
         if config_sig.status_code == 200:
             logger.debug("Successfully downloaded GPG signature")
             return config_sig.text
@@ -151,7 +273,7 @@ class InsightsConfig(object):
         Write collections rules to disk
         """
         dyn_conf_file = os.fdopen(os.open(path,
-                                          os.O_WRONLY | os.O_CREAT,
+                                          os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
                                           int("0600", 8)), 'w')
         dyn_conf_file.write(data)
         dyn_conf_file.close()
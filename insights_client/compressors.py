@@ -0,0 +1,100 @@
+"""
+Compression backends for the insights archive
+"""
+import logging
+import multiprocessing
+from distutils.spawn import find_executable
+from constants import InsightsConstants as constants
+
+logger = logging.getLogger(constants.app_name)
+
+
+def _separate(flag):
+    return lambda threads: [flag, str(threads)]
+
+
+def _attached(flag):
+    return lambda threads: [flag + str(threads)]
+
+
+class Compressor(object):
+    '''
+    A compression format and the programs that can write it
+    programs is a list of (program, threads) in order of preference,
+    threads turning a thread count into arguments, or None if the
+    program only runs single threaded
+    '''
+    def __init__(self, name, ext, tar_flag, tarfile_mode, programs):
+        self.name = name
+        self.ext = ext
+        # tar's own flag and tarfile's stream mode for this format,
+        # None if they can't write it
+        self.tar_flag = tar_flag
+        self.tarfile_mode = tarfile_mode
+        self.programs = programs
+
+    def command(self, threads=1):
+        '''
+        Command compressing stdin to stdout with up to threads threads,
+        or None if no program for this format is installed
+        '''
+        for program, thread_args in self.programs:
+            path = find_executable(program)
+            if path is None:
+                continue
+            args = [path, '-c']
+            if thread_args:
+                args.extend(thread_args(threads))
+            return args
+        return None
+
+    def is_builtin(self, threads=1):
+        '''
+        Whether tar and tarfile can write this format by themselves
+        Only used single threaded, a threaded program is preferred otherwise
+        '''
+        return self.tar_flag is not None and (threads == 1 or not self.programs or
+                                              self.command(threads) is None)
+
+
+COMPRESSORS = {
+    'gz': Compressor('gz', '.gz', 'z', 'gz',
+                     [('pigz', _separate('-p')), ('gzip', None)]),
+    'bz2': Compressor('bz2', '.bz2', 'j', 'bz2',
+                      [('pbzip2', _attached('-p')), ('bzip2', None)]),
+    # tarfile can't write xz on python 2
+    'xz': Compressor('xz', '.xz', 'J', None,
+                     [('xz', _attached('-T'))]),
+    'zstd': Compressor('zstd', '.zst', None, None,
+                       [('zstd', _attached('-T'))]),
+    'none': Compressor('none', '', '', '', []),
+}
+# the name --compressor has always documented for bz2
+COMPRESSORS['bzip2'] = COMPRESSORS['bz2']
+
+
+def get_compressor(name, threads=1):
+    '''
+    The backend for a --compressor name
+    Falls back to gz when the name is unknown or nothing can write it
+    '''
+    compressor = COMPRESSORS.get(name)
+    if compressor is None:
+        logger.warn('WARNING: Unknown compressor %s, using gz', name)
+        return COMPRESSORS['gz']
+    if not compressor.is_builtin(threads) and compressor.command(threads) is None:
+        logger.warn('WARNING: No program found for %s compression, using gz', name)
+        return COMPRESSORS['gz']
+    return compressor
+
+
+def get_threads(threads):
+    '''
+    Number of compression threads, 0 meaning one per CPU
+    '''
+    if threads == 0:
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+    return max(1, threads)
@@ -5,6 +5,8 @@ import requests
 import sys
 import os
 import json
+import time
+import threading
 
 import traceback
 import logging
@@ -17,6 +19,9 @@ from cert_auth import rhsmCertificate
 from constants import InsightsConstants as constants
 from client_config import InsightsClient
 from schedule import InsightsSchedule
+from chunked_upload import ChunkedUpload, UNSUPPORTED
+from multipart import MultipartFile
+from retry import RetryPolicy
 
 import xml.etree.ElementTree as ET
 import warnings
@@ -86,10 +91,61 @@ class InsightsConnection(object):
         self.get_proxies()
         self._validate_hostnames()
         self.session = self._init_session()
+        try:
+            attempts = InsightsClient.config.getint(APP_NAME, 'request_retries')
+        except ValueError:
+            logger.warn('WARNING: Invalid request_retries, not retrying requests')
+            attempts = 1
+        # for requests other than uploads, which are tried --retry times
+        self.retry_policy = RetryPolicy.from_config(InsightsClient.config, attempts)
+        # the upload slot held, see upload_slot
+        self.slot = None
+        # {url: (GET arguments, thread, [response, error])}, see prefetch
+        self.prefetched = {}
+        self.prefetched_lock = threading.Lock()
         # need this global -- [barfing intensifies]
         # tuple of self-signed cert flag & cert chain list
         self.cert_chain = (False, [])
 
+    def prefetch(self, url, **kwargs):
+        '''
+        Start a GET of url on a thread, for a later get() of the same url
+        with the same arguments to pick up, so independent requests are
+        under way at the same time over the session's pooled connections
+        '''
+        result = [None, None]
+
+        def fetch():
+            try:
+                result[0] = self.session.get(url, **kwargs)
+            except Exception as err:
+                result[1] = err
+        thread = threading.Thread(target=fetch, name='prefetch ' + url)
+        # a run exiting early doesn't wait for requests it won't use
+        thread.daemon = True
+        with self.prefetched_lock:
+            self.prefetched[url] = (kwargs, thread, result)
+        logger.debug('Prefetching %s', url)
+        thread.start()
+
+    def get(self, url, **kwargs):
+        '''
+        GET url, picking up the prefetched response if there is one
+        '''
+        with self.prefetched_lock:
+            prefetched = self.prefetched.pop(url, None)
+        if prefetched is None or prefetched[0] != kwargs:
+            return self.session.get(url, **kwargs)
+        thread, result = prefetched[1:]
+        thread.join()
+        logger.debug('Using prefetched response for %s', url)
+        if result[1] is not None:
+            raise result[1]
+        return result[0]
+
+    def registration_url(self):
+        return self.api_url + '/v1/systems/' + generate_machine_id()
+
     def _init_session(self):
         """
         Set up the session, auth is handled here
@@ -503,7 +559,8 @@ class InsightsConnection(object):
         """
         logger.debug("Obtaining branch information from %s",
                      self.branch_info_url)
-        branch_info = self.session.get(self.branch_info_url)
+        branch_info = self.retry_policy.call(
+            lambda: self.get(self.branch_info_url), 'branch_info request')
         logger.debug("GET branch_info status: %s", branch_info.status_code)
         try:
             logger.debug("Branch information: %s",
@@ -630,9 +687,10 @@ class InsightsConnection(object):
         Check registration status through API
         '''
         logger.debug('Checking registration status...')
-        machine_id = generate_machine_id()
+        url = self.registration_url()
         try:
-            res = self.session.get(self.api_url + '/v1/systems/' + machine_id, timeout=10)
+            res = self.retry_policy.call(lambda: self.get(url, timeout=10),
+                                         'registration check')
         except requests.ConnectionError as e:
             # can't connect, run connection test
             logger.error('Connection timed out. Running connection test...')
@@ -673,7 +731,7 @@ class InsightsConnection(object):
             logger.info(
                 "Successfully unregistered from the Red Hat Insights Service")
             write_unregistered_file()
-            InsightsSchedule().remove_scheduling()
+            InsightsSchedule(set_cron=False).remove_scheduling()
         except requests.ConnectionError as e:
             logger.debug(e)
             logger.error("Could not unregister this system")
@@ -725,6 +783,74 @@ class InsightsConnection(object):
         else:
             return (message, client_hostname, "None", "")
 
+    def _upload_chunking(self):
+        '''
+        (chunk size, chunks sent at a time), chunk size 0 for single uploads
+        '''
+        try:
+            chunk_size = InsightsClient.config.getint(APP_NAME, 'upload_chunk_size')
+            parallelism = InsightsClient.config.getint(APP_NAME, 'upload_parallelism')
+        except ValueError:
+            logger.warn('WARNING: Invalid upload_chunk_size or upload_parallelism, '
+                        'uploading in one request')
+            return 0, 1
+        return max(0, chunk_size), max(1, parallelism)
+
+    def upload_slot(self):
+        '''
+        Wait, up to upload_slot_wait seconds, for the server to let this
+        machine upload, so no more machines upload at once than it allows
+        The slot's id, None when not waiting, when the server doesn't hand
+        out slots or when the wait ran out
+        '''
+        try:
+            wait = InsightsClient.config.getint(APP_NAME, 'upload_slot_wait')
+        except ValueError:
+            logger.warn('WARNING: Invalid upload_slot_wait, uploading without a slot')
+            return None
+        if wait <= 0:
+            return None
+        slots_url = self.upload_url + '/slots'
+        deadline = time.time() + wait
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = self.session.post(
+                    slots_url, data=json.dumps({'machine_id': generate_machine_id()}),
+                    headers={'Content-Type': 'application/json'})
+            except requests.exceptions.RequestException as err:
+                logger.debug('Upload slot request failed: %s', err)
+            if response is not None:
+                if response.status_code in UNSUPPORTED:
+                    logger.debug('Upload slots not supported, uploading without one')
+                    return None
+                if response.status_code in (200, 201):
+                    slot = response.json()['slot']
+                    logger.debug('Got upload slot %s', slot)
+                    return slot
+                if not self.retry_policy.retryable(response):
+                    logger.debug('Upload slot refused: %s', response.status_code)
+                    return None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logger.warn('WARNING: No upload slot after %d seconds, uploading without one',
+                            wait)
+                return None
+            delay = min(self.retry_policy.delay(attempt, response), remaining)
+            logger.debug('Waiting %.1f seconds for an upload slot', delay)
+            self.retry_policy.sleep(delay)
+            attempt += 1
+
+    def release_upload_slot(self, slot):
+        '''
+        Give an upload slot back for the next machine
+        '''
+        try:
+            self.session.delete(self.upload_url + '/slots/' + slot)
+        except requests.exceptions.RequestException as err:
+            logger.debug('Could not release upload slot %s: %s', slot, err)
+
     def upload_archive(self, data_collected, duration, cluster=None):
         """
         Do an HTTPS Upload of the archive
@@ -741,9 +867,6 @@ class InsightsConnection(object):
             from utilities import magic_plan_b
             mime_type = magic_plan_b(data_collected)
 
-        files = {
-            'file': (file_name, open(data_collected, 'rb'), mime_type)}
-
         if cluster:
             upload_url = self.upload_url + '/' + cluster
         else:
@@ -751,8 +874,26 @@ class InsightsConnection(object):
 
         logger.debug("Uploading %s to %s", data_collected, upload_url)
 
-        headers = {'x-rh-collection-time': duration}
-        upload = self.session.post(upload_url, files=files, headers=headers)
+        headers = {'x-rh-collection-time': str(duration)}
+        if self.slot is not None:
+            headers['x-rh-upload-slot'] = self.slot
+        upload = None
+        chunk_size, parallelism = self._upload_chunking()
+        if chunk_size:
+            chunked = ChunkedUpload(self.session, upload_url, data_collected,
+                                    chunk_size, parallelism, mime_type, headers)
+            upload = chunked.upload()
+            if not chunked.started and upload.status_code in UNSUPPORTED:
+                logger.debug("Chunked uploads not supported, uploading in one request")
+                upload = None
+        if upload is None:
+            body = MultipartFile('file', data_collected, file_name, mime_type)
+            headers['Content-Type'] = body.content_type
+            headers['Content-Length'] = str(len(body))
+            try:
+                upload = self.session.post(upload_url, data=body, headers=headers)
+            finally:
+                body.close()
 
         logger.debug("Upload status: %s %s %s",
                      upload.status_code, upload.reason, upload.text)
@@ -763,3 +904,18 @@ class InsightsConnection(object):
             InsightsClient.account_number = None
         logger.debug("Upload duration: %s", upload.elapsed)
         return upload
+
+
+_SHARED = None
+
+
+def shared_connection(renew=False):
+    '''
+    The InsightsConnection the requests of a run share, so they reuse its
+    pooled connections rather than connecting again each time
+    renew to connect anew, after the credentials changed
+    '''
+    global _SHARED
+    if _SHARED is None or renew:
+        _SHARED = InsightsConnection()
+    return _SHARED
@@ -22,6 +22,10 @@ class InsightsConstants(object):
     default_ca_file = os.path.join(default_conf_dir, 'cert-api.access.redhat.com.pem')
     base_url = 'cert-api.access.redhat.com/r/insights'
     collection_rules_file = os.path.join(default_conf_dir, '.cache.json')
+    collection_rules_validators_file = os.path.join(default_conf_dir, '.cache.json.validators')
+    gpg_verified_file = os.path.join(default_conf_dir, '.cache.json.gpg-verified')
+    collection_plan_file = os.path.join(default_conf_dir, '.cache.json.plan')
+    pre_command_cache_file = os.path.join(default_conf_dir, '.cache.json.pre-commands')
     collection_fallback_file = os.path.join(default_conf_dir, '.fallback.json')
     collection_remove_file_name = 'remove.conf'
     collection_remove_file = os.path.join(default_conf_dir, collection_remove_file_name)
@@ -4,9 +4,13 @@ Collect all the interesting data for analysis
 import os
 import errno
 import json
+import socket
+import time
 import archive
 import logging
 import copy
+from fnmatch import fnmatch
+from six.moves import zip
 from subprocess import Popen, PIPE, STDOUT
 from tempfile import NamedTemporaryFile
 from soscleaner import SOSCleaner
@@ -14,6 +18,11 @@ from utilities import _expand_paths, generate_analysis_target_id
 from constants import InsightsConstants as constants
 from insights_spec import InsightsFile, InsightsCommand
 from client_config import InsightsClient
+from workers import WorkerPool
+from filters import PatternSet, OutputBudget
+from collection_plan import get_plan
+from supervisor import CommandSupervisor
+from paths import EXPANDER
 
 APP_NAME = constants.app_name
 logger = logging.getLogger(APP_NAME)
@@ -25,6 +34,78 @@ SOSCLEANER_LOGGER = logging.getLogger('insights-client.soscleaner')
 SOSCLEANER_LOGGER.setLevel(logging.ERROR)
 
 
+class PreCommandCache(object):
+    '''
+    Output of each pre_command on each mountpoint, shared by every spec
+    of a run and by later runs for ttl seconds
+    '''
+    def __init__(self, path=constants.pre_command_cache_file):
+        self.path = path
+        self.results = {}
+        self.saved = None
+
+    def reset(self):
+        '''
+        Forget what earlier runs found, keeping only what is saved
+        '''
+        self.results = {}
+        self.saved = None
+
+    def _ttl(self):
+        try:
+            return InsightsClient.config.getint(APP_NAME, 'pre_command_cache_ttl')
+        except ValueError:
+            logger.warn('WARNING: Invalid pre_command_cache_ttl, not caching pre-commands')
+            return 0
+
+    def _load_saved(self):
+        if self.saved is None:
+            self.saved = {}
+            try:
+                with open(self.path, 'r') as f:
+                    self.saved = json.load(f)
+            except (IOError, ValueError):
+                pass
+        return self.saved
+
+    def _save(self, key, output):
+        saved = self._load_saved()
+        saved[key] = {'time': time.time(), 'output': output}
+        try:
+            with os.fdopen(os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                   int('0600', 8)), 'w') as f:
+                json.dump(saved, f)
+        except (IOError, OSError) as err:
+            logger.debug('Could not cache pre-command results in %s: %s', self.path, err)
+
+    def get(self, mountpoint, pre_cmd, run):
+        '''
+        Output of pre_cmd on mountpoint, calling run(pre_cmd) if it isn't
+        known yet
+        '''
+        # a container or image lists its own interfaces, devices, ...
+        key = json.dumps([mountpoint, pre_cmd])
+        if key in self.results:
+            logger.debug('Reusing pre-command results: %s', pre_cmd)
+            return self.results[key]
+        ttl = self._ttl()
+        if ttl > 0:
+            saved = self._load_saved().get(key)
+            if saved and 0 <= time.time() - saved['time'] < ttl:
+                logger.debug('Reusing cached pre-command results: %s', pre_cmd)
+                self.results[key] = saved['output']
+                return saved['output']
+        output = run(pre_cmd)
+        self.results[key] = output
+        # failures are retried by the next run
+        if ttl > 0 and output:
+            self._save(key, output)
+        return output
+
+
+PRE_COMMAND_CACHE = PreCommandCache()
+
+
 class DataCollector(object):
     '''
     Run commands and collect files
@@ -37,6 +118,17 @@ class DataCollector(object):
         self.target_name = target_name
         self.target_type = target_type
         self.config = config
+        # specs queued for execution by _run_specs
+        self.specs = []
+        # stats of every spec run, for collection_stats.json
+        self.stats = []
+        self.collection_start = time.time()
+        # starts every command of the collection, made when first needed
+        self.supervisor = None
+        # output left for the rest of the collection, None for no limit
+        self.output_budget = self._config_bytes('collection_output_limit')
+        if self.output_budget is not None:
+            self.output_budget = OutputBudget(self.output_budget)
 
     def _get_meta_path(self, specname, conf):
         # should really never need these
@@ -45,7 +137,8 @@ class DataCollector(object):
         default_meta_spec = {'analysis_target': '/insights_data/analysis_target',
                              'branch_info': '/branch_info',
                              'machine-id': '/insights_data/machine-id',
-                             'uploader_log': '/insights_data/insights_logs/insights.log'}
+                             'uploader_log': '/insights_data/insights_logs/insights.log',
+                             'collection_stats': '/insights_data/collection_stats.json'}
         try:
             archive_path = conf['meta_specs'][specname]['archive_file_name']
         except LookupError:
@@ -84,6 +177,111 @@ class DataCollector(object):
             self.archive.add_metadata_to_archive(logfile.read().strip().decode('utf-8'),
                                                  self._get_meta_path('uploader_log', conf))
 
+    def _write_collection_stats(self, conf):
+        '''
+        Record what each spec cost, and show it with --profile-collection
+        '''
+        logger.debug('Writing collection stats to archive...')
+        stats = {'elapsed': round(time.time() - self.collection_start, 6),
+                 'workers': self._get_workers(),
+                 'spec_output_limit': self._config_bytes('spec_output_limit'),
+                 'collection_output_limit': self._config_bytes('collection_output_limit'),
+                 'truncated': [spec['name'] for spec in self.stats if spec['truncated']],
+                 'specs': self.stats}
+        self.archive.add_metadata_to_archive(json.dumps(stats),
+                                             self._get_meta_path('collection_stats', conf))
+        if getattr(InsightsClient.options, 'profile_collection', False):
+            self._show_collection_stats(stats)
+
+    def _show_collection_stats(self, stats):
+        logger.info('%10s %10s %12s %7s %5s %-9s %s', 'wall', 'cpu', 'bytes',
+                    'ratio', 'rc', 'status', 'spec')
+        for spec in sorted(stats['specs'], key=lambda s: s['wall_time'], reverse=True):
+            logger.info('%10.3f %10s %12d %7s %5s %-9s %s',
+                        spec['wall_time'],
+                        '%.3f' % spec['cpu_time'] if spec['cpu_time'] is not None else '-',
+                        spec['bytes_written'],
+                        '%.2f' % spec['filter_ratio'] if spec['filter_ratio'] is not None else '-',
+                        spec['returncode'] if spec['returncode'] is not None else '-',
+                        spec['status'], spec['name'])
+        logger.info('%d specs collected in %.3f seconds with %d workers',
+                    len(stats['specs']), stats['elapsed'], stats['workers'])
+
+    def _get_workers(self):
+        '''
+        Number of specs to execute concurrently
+        '''
+        workers = getattr(InsightsClient.options, 'workers', None)
+        if workers is None:
+            try:
+                workers = InsightsClient.config.getint(APP_NAME, 'collection_workers')
+            except ValueError:
+                logger.warn('WARNING: Invalid collection_workers, collecting serially')
+                workers = 1
+        return max(1, workers)
+
+    def _config_bytes(self, option):
+        '''
+        A byte limit from the config, None when it is 0 or invalid
+        '''
+        try:
+            limit = InsightsClient.config.getint(APP_NAME, option)
+        except ValueError:
+            logger.warn('WARNING: Invalid %s, not limiting output', option)
+            return None
+        return limit if limit > 0 else None
+
+    def _raw_copy_paths(self):
+        '''
+        Globs of the trusted files that may be copied as they are when
+        their filters would not change them
+        None with inline obfuscation, which has to see everything written
+        '''
+        if self.archive.obfuscator:
+            return None
+        paths = InsightsClient.config.get(APP_NAME, 'raw_copy_paths') or ''
+        return [path.strip() for path in paths.split(',') if path.strip()] or None
+
+    def _raw_copy(self, spec, globs):
+        '''
+        Whether a file spec is one of the trusted files, named by its path
+        on the target
+        '''
+        path = os.path.join('/', os.path.relpath(spec.real_path, self.mountpoint))
+        return [glob for glob in globs if fnmatch(path, glob)] != []
+
+    def _run_specs(self):
+        '''
+        Execute queued specs and add their output to the archive
+        Specs run on a bounded pool of workers, but output is written
+        in the order the specs were queued so the archive is deterministic
+        '''
+        specs, self.specs = self.specs, []
+        # one automaton for every pattern and exclude list, built once
+        pattern_set = PatternSet.from_specs(specs)
+        raw_copy_paths = self._raw_copy_paths()
+        spec_limit = self._config_bytes('spec_output_limit')
+        for spec in specs:
+            spec.pattern_set = pattern_set
+            spec.output_budget = self.output_budget
+            if spec.output_limit is None:
+                spec.output_limit = spec_limit
+            if isinstance(spec, InsightsFile):
+                if raw_copy_paths:
+                    spec.raw_copy = self._raw_copy(spec, raw_copy_paths)
+                    spec.spool_dir = self.archive.archive_tmp_dir
+            else:
+                if self.supervisor is None:
+                    self.supervisor = CommandSupervisor.from_config(InsightsClient.config)
+                if self.supervisor.active:
+                    spec.supervisor = self.supervisor
+        pool = WorkerPool(self._get_workers())
+        outputs = pool.imap(lambda spec: spec.get_output(), specs)
+        for spec, output in zip(specs, outputs):
+            self.archive.write_spec_output(spec, output)
+            if spec.stats:
+                self.stats.append(spec.stats)
+
     def _run_pre_command(self, pre_cmd):
         '''
         Run a pre command to get external args for a command
@@ -132,14 +330,13 @@ class DataCollector(object):
         '''
         Grab globs of things
         '''
-        import glob
-        some_globs = glob.glob(spec['glob'])
+        some_globs = EXPANDER.glob(spec['glob'])
         if not some_globs:
             return []
         el_globs = []
         for g in some_globs:
             _spec = copy.copy(spec)
-            _spec['file'] = g
+            _spec['file'] = g.path
             el_globs.append(_spec)
         return el_globs
 
@@ -151,7 +348,7 @@ class DataCollector(object):
             precmd_alias = spec['pre_command']
             try:
                 precmd = precmds[precmd_alias]
-                args = self._run_pre_command(precmd)
+                args = PRE_COMMAND_CACHE.get(self.mountpoint, precmd, self._run_pre_command)
                 logger.debug('Pre-command results: %s', args)
 
                 expanded_specs = []
@@ -180,7 +377,7 @@ class DataCollector(object):
                     # use _, archive path will be re-mangled anyway
                     s['archive_file_name'] = s['file']
                     file_spec = InsightsFile(s, exclude, self.mountpoint, self.target_name)
-                    self.archive.add_to_archive(file_spec)
+                    self.specs.append(file_spec)
         for c in conf['commands']:
             if rm_conf and 'commands' in rm_conf and c['command'] in rm_conf['commands']:
                 logger.warn("WARNING: Skipping command %s", c['command'])
@@ -191,7 +388,8 @@ class DataCollector(object):
                     # spoof archive_file_name, will be reassembled in InsightsCommand()
                     s['archive_file_name'] = os.path.join('insights_commands', '_')
                     cmd_spec = InsightsCommand(s, exclude, self.mountpoint, self.target_name, self.config)
-                    self.archive.add_to_archive(cmd_spec)
+                    self.specs.append(cmd_spec)
+        self._run_specs()
         logger.debug('Spec collection finished.')
         # collect metadata
         logger.debug('Collecting metadata...')
@@ -214,7 +412,7 @@ class DataCollector(object):
                         file_specs = self._parse_file_spec(spec)
                         for s in file_specs:
                             file_spec = InsightsFile(s, exclude, self.mountpoint, self.target_name)
-                            self.archive.add_to_archive(file_spec)
+                            self.specs.append(file_spec)
                 elif 'glob' in spec:
                     glob_specs = self._parse_glob_spec(spec)
                     for g in glob_specs:
@@ -223,7 +421,7 @@ class DataCollector(object):
                             continue
                         else:
                             glob_spec = InsightsFile(g, exclude, self.mountpoint, self.target_name)
-                            self.archive.add_to_archive(glob_spec)
+                            self.specs.append(glob_spec)
                 elif 'command' in spec:
                     if rm_conf and 'commands' in rm_conf and spec['command'] in rm_conf['commands']:
                         logger.warn("WARNING: Skipping command %s", spec['command'])
@@ -232,17 +430,20 @@ class DataCollector(object):
                         cmd_specs = self._parse_command_spec(spec, conf['pre_commands'])
                         for s in cmd_specs:
                             cmd_spec = InsightsCommand(s, exclude, self.mountpoint, self.target_name, self.config)
-                            self.archive.add_to_archive(cmd_spec)
+                            self.specs.append(cmd_spec)
         else:
             logger.debug('Spec metadata type "%s" not found in spec.', metadata_spec)
+        self._run_specs()
         logger.debug('Spec metadata collection finished.')
 
-
     def run_collection(self, conf, rm_conf, branch_info):
         '''
         Run specs and collect all the data
         '''
         logger.debug('Beginning to run collection spec...')
+        # listings and pre_command results of an earlier run may be stale
+        EXPANDER.reset()
+        PRE_COMMAND_CACHE.reset()
         exclude = None
         if rm_conf:
             try:
@@ -256,52 +457,40 @@ class DataCollector(object):
                 logger.debug('Running specific spec %s', specific_spec)
                 self.run_specific_specs(specific_spec, conf, rm_conf, exclude, branch_info)
                 logger.debug('Finished running specific spec %s', specific_spec)
+            self._write_collection_stats(conf)
             return
 
         if 'specs' not in conf or InsightsClient.options.original_style_specs:
         # if True:
             # old style collection
             self._run_old_collection(conf, rm_conf, exclude, branch_info)
+            self._write_collection_stats(conf)
             return
 
-        for specname in conf['specs']:
-            try:
-                # spec group for a s
-                spec_group = conf['specs'][specname]
-                # list of specs for a target
-                # there might be more than one spec (for compatability)
-                spec_list = spec_group[self.target_type]
-                for spec in spec_list:
-                    if 'file' in spec:
-                        if rm_conf and 'files' in rm_conf and spec['file'] in rm_conf['files']:
-                            logger.warn("WARNING: Skipping file %s", spec['file'])
-                            continue
-                        else:
-                            file_specs = self._parse_file_spec(spec)
-                            for s in file_specs:
-                                file_spec = InsightsFile(s, exclude, self.mountpoint, self.target_name)
-                                self.archive.add_to_archive(file_spec)
-                    elif 'glob' in spec:
-                        glob_specs = self._parse_glob_spec(spec)
-                        for g in glob_specs:
-                            if rm_conf and 'files' in rm_conf and g['file'] in rm_conf['files']:
-                                logger.warn("WARNING: Skipping file %s", g)
-                                continue
-                            else:
-                                glob_spec = InsightsFile(g, exclude, self.mountpoint, self.target_name)
-                                self.archive.add_to_archive(glob_spec)
-                    elif 'command' in spec:
-                        if rm_conf and 'commands' in rm_conf and spec['command'] in rm_conf['commands']:
-                            logger.warn("WARNING: Skipping command %s", spec['command'])
-                            continue
-                        else:
-                            cmd_specs = self._parse_command_spec(spec, conf['pre_commands'])
-                            for s in cmd_specs:
-                                cmd_spec = InsightsCommand(s, exclude, self.mountpoint, self.target_name, self.config)
-                                self.archive.add_to_archive(cmd_spec)
-            except LookupError:
-                logger.debug('Target type %s not found in spec %s. Skipping...', self.target_type, specname)
-                continue
+        plan = get_plan(conf, rm_conf, self.target_type)
+        for kind, name in plan.skipped:
+            logger.warn("WARNING: Skipping %s %s", kind, name)
+        for kind, spec in plan.entries:
+            if kind == 'file':
+                file_specs = self._parse_file_spec(spec)
+                for s in file_specs:
+                    file_spec = InsightsFile(s, exclude, self.mountpoint, self.target_name)
+                    self.specs.append(file_spec)
+            elif kind == 'glob':
+                glob_specs = self._parse_glob_spec(spec)
+                for g in glob_specs:
+                    if g['file'] in plan.removed_files:
+                        logger.warn("WARNING: Skipping file %s", g['file'])
+                        continue
+                    else:
+                        glob_spec = InsightsFile(g, exclude, self.mountpoint, self.target_name)
+                        self.specs.append(glob_spec)
+            elif kind == 'command':
+                cmd_specs = self._parse_command_spec(spec, conf['pre_commands'])
+                for s in cmd_specs:
+                    cmd_spec = InsightsCommand(s, exclude, self.mountpoint, self.target_name, self.config)
+                    self.specs.append(cmd_spec)
+        self._run_specs()
         logger.debug('Spec collection finished.')
 
         # collect metadata
@@ -309,6 +498,7 @@ class DataCollector(object):
         self._write_analysis_target_type(conf)
         self._write_branch_info(conf, branch_info)
         self._write_analysis_target_id(conf)
+        self._write_collection_stats(conf)
         logger.debug('Metadata collection finished.')
 
     def done(self, conf, rm_conf):
@@ -316,6 +506,10 @@ class DataCollector(object):
         Do finalization stuff
         """
         self._write_uploader_log(conf)
+        if self.archive.obfuscator:
+            # everything was obfuscated on its way into the archive
+            self.archive.obfuscator.finish()
+            return self.archive.create_tar_file()
         if InsightsClient.config.getboolean(APP_NAME, "obfuscate"):
             cleaner = SOSCleaner(quiet=True)
             clean_opts = CleanOptions(self.archive.tmp_dir, rm_conf)
@@ -337,6 +531,12 @@ class CleanOptions(object):
         self.quiet = True
         self.keyword_file = None
         self.keywords = None
+        self.workers = 1
+
+        try:
+            self.workers = InsightsClient.config.getint(APP_NAME, "obfuscation_workers")
+        except ValueError:
+            logger.warn('WARNING: Invalid obfuscation_workers, obfuscating serially')
 
         if rm_conf:
             try:
@@ -354,3 +554,42 @@ class CleanOptions(object):
             self.hostname_path = "insights_commands/hostname"
         else:
             self.hostname_path = None
+
+
+class InlineObfuscator(object):
+    """
+    Obfuscates data as it is written to the archive, instead of copying
+    and cleaning the finished archive directory with SOSCleaner
+    """
+    def __init__(self, rm_conf, root=None):
+        self.cleaner = SOSCleaner(quiet=True)
+        self.options = CleanOptions(None, rm_conf)
+        self.root = root if root else '/'
+        # what the collected insights_commands/hostname would hold
+        self.hostname = socket.gethostname() if self.options.hostname_path else None
+
+    def start(self, report_dir):
+        """
+        Load the databases, reports are written to report_dir
+        """
+        self.options.report_dir = report_dir
+        self.cleaner.start_inline(self.options, self.hostname, self.root)
+        if self.options.keyword_file is not None:
+            os.remove(self.options.keyword_file.name)
+
+    def archive_hostname(self, hostname):
+        """
+        The hostname to name the archive after
+        """
+        if self.cleaner.hostname:
+            return self.cleaner._sub_hostname(hostname)
+        return hostname
+
+    def clean(self, data):
+        return self.cleaner.clean_text(data)
+
+    def finish(self):
+        """
+        Write the reports
+        """
+        return self.cleaner.finish_inline()
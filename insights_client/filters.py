@@ -0,0 +1,783 @@
+"""
+In-process filtering of spec output
+
+Equivalent to piping the output through
+  /bin/sed -rf .exp.sed | /bin/grep -F -v -f <exclude> | /bin/grep -F -f <pattern>
+without forking any of those processes or writing pattern temp files.
+"""
+import os
+import re
+import sre_parse
+import sre_constants
+import logging
+import threading
+import string
+import six
+from bisect import bisect_right
+from six.moves import filter, filterfalse
+from subprocess import Popen, PIPE
+from constants import InsightsConstants as constants
+
+logger = logging.getLogger(constants.app_name)
+
+# what grep prints instead of lines once it decides its input is binary
+GREP_BINARY_MESSAGE = 'Binary file (standard input) matches\n'
+# how much to read at once, lines are never split across blocks
+BLOCK_SIZE = 65536
+# grep tests each line of a block when more than one in this many of its
+# first lines match, otherwise it finds the matches in the whole block
+SPARSE_MATCHES = 8
+SAMPLE_LINES = 64
+maketrans = bytes.maketrans if six.PY3 else string.maketrans
+# appended to output cut short by an output limit
+TRUNCATED_MARKER = '\n[insights-client: output truncated after %d bytes]\n'
+
+POSIX_CLASSES = {'alnum': 'a-zA-Z0-9',
+                 'alpha': 'a-zA-Z',
+                 'blank': ' \\t',
+                 'cntrl': '\\x00-\\x1f\\x7f',
+                 'digit': '0-9',
+                 'graph': '\\x21-\\x7e',
+                 'lower': 'a-z',
+                 'print': '\\x20-\\x7e',
+                 'punct': '!-/:-@\\[-`{-~',
+                 'space': ' \\t\\n\\r\\f\\v',
+                 'upper': 'A-Z',
+                 'xdigit': '0-9A-Fa-f'}
+
+# compiled sed scripts, keyed by path
+_sed_cache = {}
+
+
+class UnsupportedSedScript(ValueError):
+    '''
+    The sed script uses something we can't run in-process
+    '''
+    pass
+
+
+def _translate_bracket(ere, i):
+    '''
+    Translate the POSIX bracket expression starting at ere[i] ('[')
+    Returns the python equivalent and the index after the closing ']'
+    '''
+    out = ['[']
+    i += 1
+    if i < len(ere) and ere[i] == '^':
+        out.append('^')
+        i += 1
+    # a leading ']' is a literal
+    if i < len(ere) and ere[i] == ']':
+        out.append('\\]')
+        i += 1
+    while i < len(ere):
+        char = ere[i]
+        if char == ']':
+            out.append(']')
+            return ''.join(out), i + 1
+        if ere.startswith('[:', i):
+            end = ere.find(':]', i + 2)
+            if end < 0 or ere[i + 2:end] not in POSIX_CLASSES:
+                raise UnsupportedSedScript('Unknown character class in %s' % ere)
+            out.append(POSIX_CLASSES[ere[i + 2:end]])
+            i = end + 2
+            continue
+        if ere.startswith('[=', i) or ere.startswith('[.', i):
+            raise UnsupportedSedScript('Collating element in %s' % ere)
+        if char == '\\':
+            # GNU sed only special cases a few escapes inside brackets
+            if ere[i + 1:i + 2] in ('n', 't', '\\', ']'):
+                out.append(ere[i:i + 2])
+                i += 2
+                continue
+            out.append('\\\\')
+        elif char == '[':
+            out.append('\\[')
+        else:
+            out.append(char)
+        i += 1
+    raise UnsupportedSedScript('Unterminated bracket expression in %s' % ere)
+
+
+def _literal_prefix(regex, flags):
+    '''
+    The literal string every match of a python regex starts with, looking
+    into leading groups, '' if there is none
+    '''
+    if flags & re.IGNORECASE:
+        return ''
+    try:
+        items = sre_parse.parse(regex, flags)
+    except (re.error, sre_parse.error):
+        return ''
+    prefix = []
+
+    def walk(items):
+        '''
+        Add the leading literals of items, True if all of them were
+        '''
+        for op, av in items:
+            if op == sre_constants.LITERAL:
+                prefix.append(chr(av))
+            elif op == sre_constants.SUBPATTERN:
+                if not walk(av[-1]):
+                    return False
+            else:
+                return False
+        return True
+    walk(items)
+    return ''.join(prefix)
+
+
+def _translate_regex(ere, delim):
+    '''
+    Translate a GNU extended regular expression into a python one
+    '''
+    out = []
+    i = 0
+    while i < len(ere):
+        char = ere[i]
+        if char == '\\':
+            nxt = ere[i + 1:i + 2]
+            if not nxt:
+                raise UnsupportedSedScript('Trailing backslash in %s' % ere)
+            if nxt == delim:
+                out.append(re.escape(delim))
+            elif nxt == '<':
+                out.append('\\b(?=\\w)')
+            elif nxt == '>':
+                out.append('\\b(?<=\\w)')
+            elif nxt == '`':
+                out.append('\\A')
+            elif nxt == "'":
+                out.append('\\Z')
+            else:
+                out.append(char + nxt)
+            i += 2
+            continue
+        if char == '[':
+            bracket, i = _translate_bracket(ere, i)
+            out.append(bracket)
+            continue
+        if char in '*+?}' and ere[i + 1:i + 2] == '?':
+            # (x*)? in ERE, but a lazy quantifier in python
+            raise UnsupportedSedScript('Stacked quantifier in %s' % ere)
+        out.append(char)
+        i += 1
+    return ''.join(out)
+
+
+def _parse_replacement(repl, delim):
+    '''
+    Split a sed replacement into literal strings and group numbers
+    '''
+    parts = []
+    literal = []
+    i = 0
+    while i < len(repl):
+        char = repl[i]
+        if char == '\\':
+            nxt = repl[i + 1:i + 2]
+            if nxt.isdigit():
+                parts.append(''.join(literal))
+                literal = []
+                parts.append(int(nxt))
+            elif nxt == 'n':
+                literal.append('\n')
+            elif nxt == 't':
+                literal.append('\t')
+            elif nxt in ('L', 'U', 'l', 'u', 'E'):
+                raise UnsupportedSedScript('Case conversion in %s' % repl)
+            else:
+                # \&, \\, \<delim> and anything else are literals
+                literal.append(nxt)
+            i += 2
+            continue
+        if char == '&':
+            parts.append(''.join(literal))
+            literal = []
+            parts.append(0)
+        else:
+            literal.append(char)
+        i += 1
+    parts.append(''.join(literal))
+    return [p for p in parts if p != '']
+
+
+def _split_command(script, i, delim):
+    '''
+    Read one delimited section of an s command starting at script[i]
+    Returns the section and the index after its closing delimiter
+    '''
+    section = []
+    while i < len(script):
+        char = script[i]
+        if char == '\\' and i + 1 < len(script):
+            section.append(script[i:i + 2])
+            i += 2
+            continue
+        if char == delim:
+            return ''.join(section), i + 1
+        if char == '\n':
+            break
+        section.append(char)
+        i += 1
+    raise UnsupportedSedScript('Unterminated s command')
+
+
+def _split_at_newlines(block, joined):
+    '''
+    Whether a newline ends each line of block, joined being
+    ''.join(block), and there are none anywhere else
+    Lines are read with one ending each but the last, only a sed
+    replacement adds more
+    '''
+    ended = len(block) if block[-1].endswith('\n') else len(block) - 1
+    return bool(block[-1]) and joined.count('\n') == ended
+
+
+def _line_indexes(joined, offsets):
+    '''
+    Indexes of the lines of a block split at its newlines, joined being
+    ''.join(block), that the sorted offsets into joined fall in, each
+    index once
+    '''
+    # the line an offset is in is the number of newlines before it
+    indexes = []
+    i = 0
+    counted = 0
+    for offset in offsets:
+        i += joined.count('\n', counted, offset)
+        counted = offset
+        if not indexes or indexes[-1] != i:
+            indexes.append(i)
+    return indexes
+
+
+def _hit_lines(block, joined, search):
+    '''
+    Indexes of the lines of block search finds a match in, joined being
+    ''.join(block)
+    Only joined is searched: after each match the search starts again at
+    the next line, so every line search matches on its own is found
+    '''
+    match = search(joined)
+    if match is None:
+        return []
+    if _split_at_newlines(block, joined):
+        offsets = []
+        while match is not None:
+            start = match.start()
+            offsets.append(start)
+            start = joined.find('\n', start) + 1
+            if not start or start == len(joined):
+                break
+            match = search(joined, start)
+        return _line_indexes(joined, offsets)
+    hits = []
+    starts = []
+    start = 0
+    for line in block:
+        starts.append(start)
+        start += len(line)
+    while match is not None:
+        i = bisect_right(starts, match.start()) - 1
+        hits.append(i)
+        if i + 1 == len(starts):
+            break
+        match = search(joined, starts[i + 1])
+    return hits
+
+
+class SedSubstitution(object):
+    '''
+    A single s/regex/replacement/flags command
+    '''
+    def __init__(self, regex, replacement, flags, delim='/'):
+        if regex == '':
+            raise UnsupportedSedScript('Empty regex reuses the last regex')
+        re_flags = 0
+        self.count = 1
+        for flag in flags:
+            if flag == 'g':
+                self.count = 0
+            elif flag in ('i', 'I'):
+                re_flags |= re.IGNORECASE
+            else:
+                raise UnsupportedSedScript('Unsupported s flag %s' % flag)
+        translated = _translate_regex(regex, delim)
+        try:
+            self.regex = re.compile(translated, re_flags)
+        except re.error as err:
+            raise UnsupportedSedScript('Cannot compile %s: %s' % (regex, err))
+        # matches somewhere in a block of lines whenever self.regex matches
+        # one of them, so blocks without a match can be passed through
+        self.probe = None
+        if '\\A' not in translated and '\\Z' not in translated:
+            self.probe = re.compile(translated, re_flags | re.MULTILINE)
+        # what every match starts with, for str.find to skip ahead to
+        self.prefix = _literal_prefix(translated, re_flags)
+        self.parts = _parse_replacement(replacement, delim)
+
+    def _expand(self, match):
+        return ''.join([part if isinstance(part, str) else (match.group(part) or '')
+                        for part in self.parts])
+
+    def apply(self, line):
+        return self.regex.sub(self._expand, line, self.count)
+
+    def search(self, joined, pos=0):
+        '''
+        The probe's first match in joined from pos
+        With a literal prefix, only the places it occurs are tried, which
+        the re module does not do by itself for a prefix inside a group
+        '''
+        if not self.prefix:
+            return self.probe.search(joined, pos)
+        find = joined.find
+        match = self.probe.match
+        pos = find(self.prefix, pos)
+        while pos >= 0:
+            found = match(joined, pos)
+            if found is not None:
+                return found
+            pos = find(self.prefix, pos + 1)
+        return None
+
+    def _apply_line(self, line):
+        if line.endswith('\n'):
+            return self.apply(line[:-1]) + '\n'
+        return self.apply(line)
+
+    def apply_block(self, block, joined):
+        '''
+        Run the command over a block of lines, joined being ''.join(block)
+        Only the lines the probe finds a match in are edited: the probe is
+        searched for again from the start of the line after each match,
+        so every line the command matches on its own is visited
+        '''
+        if self.probe is None or not block:
+            return [self._apply_line(line) for line in block]
+        hits = _hit_lines(block, joined, self.search)
+        if not hits:
+            return block
+        block = list(block)
+        for i in hits:
+            block[i] = self._apply_line(block[i])
+        return block
+
+
+class SedScript(object):
+    '''
+    A sed script made only of s commands, run in-process
+    '''
+    def __init__(self, commands):
+        self.commands = commands
+
+    @classmethod
+    def parse(cls, script):
+        commands = []
+        i = 0
+        while i < len(script):
+            char = script[i]
+            if char in ' \t\n;':
+                i += 1
+            elif char == '#':
+                end = script.find('\n', i)
+                i = len(script) if end < 0 else end
+            elif char == 's' and i + 1 < len(script):
+                delim = script[i + 1]
+                if delim in '\\\n':
+                    raise UnsupportedSedScript('Invalid delimiter')
+                regex, i = _split_command(script, i + 2, delim)
+                replacement, i = _split_command(script, i, delim)
+                start = i
+                while i < len(script) and script[i] not in ' \t\n;#}':
+                    i += 1
+                commands.append(SedSubstitution(regex, replacement, script[start:i], delim))
+            else:
+                raise UnsupportedSedScript('Only s commands are supported, found %s' % char)
+        return cls(commands)
+
+    def apply(self, line):
+        '''
+        Run the script over one line, without its newline
+        '''
+        for command in self.commands:
+            line = command.apply(line)
+        return line
+
+    def filter(self, blocks):
+        '''
+        Run the script over blocks of lines
+        '''
+        for block in blocks:
+            joined = ''.join(block)
+            for command in self.commands:
+                edited = command.apply_block(block, joined)
+                if edited is not block:
+                    block = edited
+                    joined = ''.join(block)
+            yield block
+
+
+def get_sed_script(path=constants.default_sed_file):
+    '''
+    Load and compile a sed script, or None if it has to be run by /bin/sed
+    '''
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        logger.debug('Could not stat sed file %s', path)
+        return None
+    cached = _sed_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path) as sed_file:
+            script = SedScript.parse(sed_file.read())
+    except (IOError, UnsupportedSedScript) as err:
+        logger.debug('Falling back to /bin/sed for %s: %s', path, err)
+        script = None
+    _sed_cache[path] = (mtime, script)
+    return script
+
+
+def _read_blocks(stream, size=BLOCK_SIZE):
+    '''
+    Lists of lines read from a file object, about size bytes at a time
+    '''
+    while True:
+        block = stream.readlines(size)
+        if not block:
+            return
+        yield block
+
+
+def _sed_subprocess(stream, path):
+    '''
+    Run the stream through /bin/sed
+    '''
+    proc = Popen(['/bin/sed', '-rf', path.encode('utf-8')],
+                 stdin=stream, stdout=PIPE, close_fds=True)
+    try:
+        for block in _read_blocks(proc.stdout):
+            yield block
+    finally:
+        # also when the reader stops early, sed then gets SIGPIPE
+        proc.stdout.close()
+        proc.wait()
+
+
+def fixed_strings(patterns):
+    '''
+    The patterns grep -F -f reads from a file holding "\\n".join(patterns)
+    '''
+    content = '\n'.join(patterns)
+    if isinstance(content, six.text_type):
+        content = content.encode('utf-8')
+    if content.endswith('\n'):
+        content = content[:-1]
+    return content.split('\n') if content else []
+
+
+class PatternSet(object):
+    '''
+    Trie over the fixed strings of every spec in a collection run
+
+    Built once, each spec then filters through its own PatternView.  Every
+    pattern gets a bit, and the subset of the trie a view needs is compiled
+    into a single regex, so each line is matched in one pass through the
+    re engine however many patterns the view has.
+    '''
+    def __init__(self, patterns=()):
+        self.bits = {}
+        for pattern in patterns:
+            if pattern and pattern not in self.bits:
+                self.bits[pattern] = 1 << len(self.bits)
+        # children, bit of the pattern ending here and bits of all the
+        # patterns below each node
+        self.children = [{}]
+        self.final = [0]
+        self.below = [0]
+        for pattern, bit in self.bits.items():
+            node = 0
+            self.below[node] |= bit
+            for char in pattern:
+                nxt = self.children[node].get(char)
+                if nxt is None:
+                    nxt = len(self.children)
+                    self.children[node][char] = nxt
+                    self.children.append({})
+                    self.final.append(0)
+                    self.below.append(0)
+                node = nxt
+                self.below[node] |= bit
+            self.final[node] = bit
+        # compiled regexes, keyed by the mask of the patterns they match
+        self._regexes = {}
+
+    @classmethod
+    def from_specs(cls, specs):
+        '''
+        The set of the pattern and exclude lists of a list of specs
+        '''
+        patterns = []
+        for spec in specs:
+            for strings in (spec.pattern, spec.exclude):
+                if strings:
+                    patterns.extend(fixed_strings(strings))
+        return cls(patterns)
+
+    def _trie_regex(self, node, mask):
+        alternatives = [re.escape(char) + self._trie_regex(nxt, mask)
+                        for char, nxt in sorted(self.children[node].items())
+                        if self.below[nxt] & mask]
+        final = self.final[node] & mask
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1 and not final:
+            return alternatives[0]
+        regex = '(?:' + '|'.join(alternatives) + ')'
+        if final:
+            # longer patterns through this node are optional
+            regex += '?'
+        return regex
+
+    def regex(self, mask):
+        '''
+        Compiled regex matching any of the patterns in mask
+        '''
+        regex = self._regexes.get(mask)
+        if regex is None:
+            regex = re.compile(self._trie_regex(0, mask))
+            self._regexes[mask] = regex
+        return regex
+
+    def view(self, patterns):
+        return PatternView(self, patterns)
+
+
+class PatternView(object):
+    '''
+    The subset of a PatternSet one grep -F -f invocation would search for
+    '''
+    def __init__(self, pattern_set, patterns):
+        self.patterns = fixed_strings(patterns)
+        # an empty pattern matches every line
+        self.match_all = '' in self.patterns
+        self.regex = None
+        if self.patterns and not self.match_all:
+            if [p for p in self.patterns if p not in pattern_set.bits]:
+                # not built from these patterns, use a private set
+                pattern_set = PatternSet(self.patterns)
+            mask = 0
+            for pattern in self.patterns:
+                mask |= pattern_set.bits[pattern]
+            self.regex = pattern_set.regex(mask)
+        # a line with a pattern containing another has the other too
+        self.shortest = [p for p in set(self.patterns)
+                         if not [q for q in self.patterns if q != p and q in p]]
+        self.scanner = None
+
+    def _scanner(self, sample):
+        '''
+        (table, regex) finding in one pass where a pattern may occur in a
+        block translated with table
+        Each pattern is anchored at its character least frequent in sample
+        and table turns all the anchors into one, so the regex over the
+        rest of the patterns starts with a single literal, which the re
+        engine skips ahead to without trying a match anywhere else
+        '''
+        counts = {}
+        anchored = []
+        for pattern in self.shortest:
+            chars = [pattern[i:i + 1] for i in range(len(pattern))]
+            for char in chars:
+                if char not in counts:
+                    counts[char] = sample.count(char)
+            anchor = min(range(len(chars)), key=lambda i: counts[chars[i]])
+            anchored.append((chars[anchor], pattern[anchor:]))
+        anchors = b''.join(sorted(set([anchor for anchor, _ in anchored])))
+        table = maketrans(anchors, anchors[:1] * len(anchors))
+        rests = PatternSet([rest.translate(table) for _, rest in anchored])
+        return table, rests.regex((1 << len(rests.bits)) - 1)
+
+    def select(self, lines, joined, invert=False):
+        '''
+        The lines containing (or with invert, not containing) a pattern
+        joined is ''.join(lines), scanned as a whole when few lines match
+        '''
+        if self.regex is None:
+            return [] if self.match_all == invert else lines
+        search = self.regex.search
+        sample = lines[:SAMPLE_LINES]
+        if (len(list(filter(search, sample))) * SPARSE_MATCHES > len(sample) or
+                not _split_at_newlines(lines, joined) or
+                (self.scanner is None and len(joined) < BLOCK_SIZE)):
+            # matches on many lines, or too few lines to build the scanner
+            # for, test each line: filter calls search from C with no
+            # bytecode run per line
+            if invert:
+                return list(filterfalse(search, lines))
+            return list(filter(search, lines))
+        # matches on few lines, find where they may be in one pass over
+        # joined, check those lines and leave the rest to list slicing
+        if self.scanner is None:
+            self.scanner = self._scanner(''.join(sample))
+        table, scan = self.scanner
+        offsets = [match.start() for match in scan.finditer(joined.translate(table))]
+        hits = [i for i in _line_indexes(joined, offsets) if search(lines[i])]
+        if not hits:
+            return lines if invert else []
+        if not invert:
+            return [lines[i] for i in hits]
+        selected = []
+        start = 0
+        for i in hits:
+            selected.extend(lines[start:i])
+            start = i + 1
+        selected.extend(lines[start:])
+        return selected
+
+
+def _grep(blocks, matcher, invert=False):
+    '''
+    Select the lines grep -F (or grep -F -v) would print
+    Once grep sees a NUL byte in what it has read it treats the input as
+    binary: the next selected line is reported with a single message and
+    grep stops
+    '''
+    binary = False
+    for block in blocks:
+        joined = ''.join(block)
+        if not binary and '\0' in joined:
+            binary = True
+        # an empty string is an unterminated last line sed emptied,
+        # grep doesn't see a line there
+        selected = list(filter(None, matcher.select(block, joined, invert)))
+        if not selected:
+            continue
+        if binary:
+            yield [GREP_BINARY_MESSAGE]
+            return
+        if not selected[-1].endswith('\n'):
+            selected[-1] += '\n'
+        yield selected
+
+
+class OutputBudget(object):
+    '''
+    Bytes of output all specs of a collection may still write,
+    shared by the collection workers
+    '''
+    def __init__(self, size):
+        self.left = size
+        self.lock = threading.Lock()
+
+    def take(self, size):
+        '''
+        Take up to size bytes, returning how many were left to take
+        '''
+        with self.lock:
+            taken = min(size, self.left)
+            self.left -= taken
+            return taken
+
+    def give(self, size):
+        with self.lock:
+            self.left += size
+
+
+class SpecFilter(object):
+    '''
+    The filters applied to the output of one spec
+    Output stops at limit bytes, or when budget runs out, and is then
+    marked as truncated
+    '''
+    def __init__(self, pattern=None, exclude=None, sed_file=constants.default_sed_file,
+                 pattern_set=None, limit=None, budget=None):
+        self.sed_file = sed_file
+        self.limit = limit
+        self.budget = budget
+        self.truncated = False
+        if pattern_set is None:
+            pattern_set = PatternSet(fixed_strings(pattern or []) +
+                                     fixed_strings(exclude or []))
+        self.exclude = pattern_set.view(exclude) if exclude is not None else None
+        self.pattern = pattern_set.view(pattern) if pattern else None
+        # bytes read before filtering, None when /bin/sed reads the stream
+        self.bytes_read = None
+
+    def _count(self, blocks):
+        self.bytes_read = 0
+        for block in blocks:
+            self.bytes_read += sum(map(len, block))
+            yield block
+
+    def blocks(self, stream):
+        '''
+        Generator of blocks of filtered lines read from a file object
+        '''
+        script = get_sed_script(self.sed_file)
+        if script:
+            blocks = script.filter(self._count(_read_blocks(stream)))
+        else:
+            blocks = _sed_subprocess(stream, self.sed_file)
+        if self.exclude is not None:
+            blocks = _grep(blocks, self.exclude, invert=True)
+        if self.pattern is not None:
+            blocks = _grep(blocks, self.pattern)
+        return blocks
+
+    def passes_through(self, stream, spool=None):
+        '''
+        Whether filtering a file object would leave it unchanged:
+        nothing is selected or excluded and no sed command matches
+        any of its lines
+        Reads the file object to the end in blocks, writing each block
+        checked to spool when given
+        '''
+        if self.pattern is not None or (self.exclude is not None and
+                                         self.exclude.patterns):
+            return False
+        script = get_sed_script(self.sed_file)
+        if script is None:
+            return False
+        if None in [command.probe for command in script.commands]:
+            return False
+        for block in self._count(_read_blocks(stream)):
+            joined = ''.join(block)
+            for command in script.commands:
+                if command.search(joined):
+                    return False
+            if spool is not None:
+                spool.write(joined)
+        return True
+
+    def apply(self, stream):
+        '''
+        Filtered output of a file object, as a byte string
+        Stops reading once the output is over its limit or budget
+        '''
+        if self.limit is None and self.budget is None:
+            return ''.join([''.join(block) for block in self.blocks(stream)])
+        output = []
+        written = 0
+        blocks = self.blocks(stream)
+        for block in blocks:
+            data = ''.join(block)
+            allowed = len(data)
+            if self.limit is not None:
+                allowed = min(allowed, self.limit - written)
+            if self.budget is not None:
+                allowed = self.budget.take(allowed)
+            written += allowed
+            if allowed < len(data):
+                output.append(data[:allowed])
+                output.append(TRUNCATED_MARKER % written)
+                self.truncated = True
+                blocks.close()
+                break
+            output.append(data)
+        return ''.join(output)
@@ -1,15 +1,21 @@
 import os
 import re
+import stat
+import time
+import tempfile
 from subprocess import Popen, PIPE, STDOUT
 import errno
 import shlex
 import logging
 import six
-from tempfile import NamedTemporaryFile
 from utilities import determine_hostname
+from filters import SpecFilter
+from paths import EXPANDER
 from constants import InsightsConstants as constants
 
 logger = logging.getLogger(constants.app_name)
+# files whose reported size says nothing about their content
+PSEUDO_FILESYSTEMS = ('/proc', '/sys')
 
 
 class InsightsSpec(object):
@@ -23,6 +29,55 @@ class InsightsSpec(object):
         self.pattern = spec['pattern'] if spec['pattern'] else None
         # absolute destination inside the archive for this spec
         self.archive_path = spec['archive_file_name']
+        # automaton shared by all specs of a collection run
+        self.pattern_set = None
+        # most bytes of output to keep, from the rules or the config
+        self.output_limit = spec.get('max_bytes')
+        # OutputBudget shared by all specs of a collection run
+        self.output_budget = None
+        # what the last get_output cost, see _record_stats
+        self.stats = None
+
+    def get_filter(self):
+        '''
+        Filters to apply to the output of this spec
+        '''
+        return SpecFilter(self.pattern, self.exclude, pattern_set=self.pattern_set,
+                          limit=self.output_limit, budget=self.output_budget)
+
+    def get_name(self):
+        '''
+        What this spec collects, for logs and stats
+        '''
+        return self.archive_path
+
+    def _record_stats(self, start, status, returncode=None, rusage=None,
+                      spec_filter=None, output=None):
+        '''
+        Record how the last get_output went
+        status is one of ok, timeout, not_found, missing or error
+        '''
+        bytes_read = spec_filter.bytes_read if spec_filter else None
+        bytes_written = len(output) if output is not None else 0
+        truncated = bool(spec_filter and spec_filter.truncated)
+        if truncated:
+            logger.warn('WARNING: Output of %s truncated', self.get_name())
+        self.stats = {'name': self.get_name(),
+                      'archive_path': self.archive_path,
+                      'status': status,
+                      'returncode': returncode,
+                      'wall_time': round(time.time() - start, 6),
+                      'cpu_time': (round(rusage.ru_utime + rusage.ru_stime, 6)
+                                   if rusage is not None else None),
+                      # in KiB on Linux
+                      'max_rss': rusage.ru_maxrss if rusage is not None else None,
+                      'blocks_read': rusage.ru_inblock if rusage is not None else None,
+                      'blocks_written': rusage.ru_oublock if rusage is not None else None,
+                      'bytes_read': bytes_read,
+                      'bytes_written': bytes_written,
+                      'truncated': truncated,
+                      'filter_ratio': (round(float(bytes_written) / bytes_read, 4)
+                                       if bytes_read else None)}
 
 
 class InsightsCommand(InsightsSpec):
@@ -49,6 +104,11 @@ class InsightsCommand(InsightsSpec):
             self.command = self.command.encode('utf-8', 'ignore')
         self.black_list = ['rm', 'kill', 'reboot', 'shutdown']
         self.config = config
+        # CommandSupervisor starting the command, if any
+        self.supervisor = None
+
+    def get_name(self):
+        return self.command
 
     def _mangle_command(self, command, name_max=255):
         """
@@ -83,95 +143,61 @@ class InsightsCommand(InsightsSpec):
         if set.intersection(set(args), set(self.black_list)):
             raise RuntimeError("Command Blacklist")
 
+        start = time.time()
         try:
             logger.debug('Executing: %s', args)
-            proc0 = Popen(args, shell=False, stdout=PIPE, stderr=STDOUT,
+            popen = self.supervisor.popen if self.supervisor else Popen
+            proc0 = popen(args, shell=False, stdout=PIPE, stderr=STDOUT,
                           bufsize=-1, env=cmd_env, close_fds=True)
         except OSError as err:
             if err.errno == errno.ENOENT:
                 logger.debug('Command %s not found', self.command)
+                self._record_stats(start, 'not_found')
                 return
             else:
                 raise err
 
-        dirty = False
-
-        cmd = "/bin/sed -rf " + constants.default_sed_file
-        sedcmd = Popen(shlex.split(cmd.encode('utf-8')),
-                       stdin=proc0.stdout,
-                       stdout=PIPE)
+        spec_filter = self.get_filter()
+        stdout = spec_filter.apply(proc0.stdout)
+        if spec_filter.truncated:
+            # timeout passes the signal on to the command
+            proc0.terminate()
         proc0.stdout.close()
-        proc0 = sedcmd
-
-        if self.exclude is not None:
-            exclude_file = NamedTemporaryFile()
-            exclude_file.write("\n".join(self.exclude))
-            exclude_file.flush()
-            cmd = "/bin/grep -F -v -f %s" % exclude_file.name
-            proc1 = Popen(shlex.split(cmd.encode("utf-8")),
-                          stdin=proc0.stdout,
-                          stdout=PIPE)
-            proc0.stdout.close()
-            stderr = None
-            if self.pattern is None or len(self.pattern) == 0:
-                stdout, stderr = proc1.communicate()
-
-            # always log return codes for debug
-            logger.debug('Proc1 Status: %s', proc1.returncode)
-            logger.debug('Proc1 stderr: %s', stderr)
-            proc0 = proc1
-
-            # if the return code was not zero
-            # indicates timeout or absence
-            if proc1.returncode > 0:
-                logger.debug('Process return code indicates timeout or absence.')
-                # no command indicates timeout
-                if not self.cmd_exists(self.command):
-                    logger.debug('Command %s not found.', self.command)
-                else:
-                    logger.debug('Command %s found. Timeout occurred.', self.command)
-
-            dirty = True
-
-        if self.pattern is not None and len(self.pattern):
-            pattern_file = NamedTemporaryFile()
-            pattern_file.write("\n".join(self.pattern))
-            pattern_file.flush()
-            cmd = "/bin/grep -F -f %s" % pattern_file.name
-            proc2 = Popen(shlex.split(cmd.encode("utf-8")),
-                          stdin=proc0.stdout,
-                          stdout=PIPE)
-            proc0.stdout.close()
-            stdout, stderr = proc2.communicate()
-
-            # always log return codes for debug
-            logger.debug('Proc2 Status: %s', proc2.returncode)
-            logger.debug('Proc2 stderr: %s', stderr)
-
-            # if the return code was not zero
-            # indicates timeout or absence
-            if proc2.returncode > 0:
-                logger.debug('Process return code indicates timeout or absence.')
-                # no command indicates timeout
-                if not self.cmd_exists(self.command):
-                    logger.debug('Command %s not found.', self.command)
-                else:
-                    logger.debug('Command %s found. Timeout occurred.', self.command)
-
-            dirty = True
-
-        if not dirty:
-            stdout, stderr = proc0.communicate()
-
-        # Required hack while we still pass shell=True to Popen; a Popen
-        # call with shell=False for a non-existant binary will raise OSError.
-        if proc0.returncode == 126 or proc0.returncode == 127:
-            stdout = "Could not find cmd: %s", self.command
+        rusage = self._wait(proc0)
+        if self.supervisor:
+            self.supervisor.release(proc0)
 
+        # always log return codes for debug
         logger.debug("Proc0 Status: %s", proc0.returncode)
-        logger.debug("Proc0 stderr: %s", stderr)
+        status = 'ok'
+        if proc0.returncode == 124:
+            logger.debug('Command %s found. Timeout occurred.', self.command)
+            status = 'timeout'
+        elif proc0.returncode in (126, 127):
+            logger.debug('Command %s not found.', self.command)
+            status = 'not_found'
+        self._record_stats(start, status, proc0.returncode,
+                           rusage, spec_filter, stdout)
         return stdout.decode('utf-8', 'ignore')
 
+    def _wait(self, proc):
+        '''
+        Wait for the command like Popen.wait, returning its resource usage
+        (including what timeout's child used)
+        '''
+        while True:
+            try:
+                pid, status, rusage = os.wait4(proc.pid, 0)
+                break
+            except OSError as err:
+                if err.errno != errno.EINTR:
+                    raise
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        return rusage
+
     def cmd_exists(self, command):
         """
         Check if a command exists using native which
@@ -190,12 +216,32 @@ class InsightsCommand(InsightsSpec):
             return True
 
 
+class RawFile(object):
+    '''
+    The bytes of a file its filters would not change, spooled as they
+    were checked, to be copied into the archive as they are
+    '''
+    def __init__(self, spool, size):
+        self.spool = spool
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self.spool.close()
+
+
 class InsightsFile(InsightsSpec):
     '''
     A file spec
     '''
     def __init__(self, spec, exclude, mountpoint, target_name):
         InsightsSpec.__init__(self, spec, exclude)
+        # whether get_output may hand back a RawFile
+        self.raw_copy = False
+        # where a RawFile spools its bytes, None for the default temp dir
+        self.spool_dir = None
         # substitute mountpoint for collection
         self.real_path = spec['file'].replace(
             '{CONTAINER_MOUNT_POINT}', mountpoint).replace(
@@ -208,56 +254,87 @@ class InsightsFile(InsightsSpec):
             '{DOCKER_CONTAINER_NAME}', target_name)
         self.archive_path = self.archive_path.replace('{EXPANDED_FILE_NAME}', self.relative_path)
 
+    def get_name(self):
+        return self.real_path
+
+    def _pseudo_file(self):
+        for root in PSEUDO_FILESYSTEMS:
+            if self.real_path == root or self.real_path.startswith(root + '/'):
+                return True
+        return False
+
+    def _raw_file(self, spec_filter):
+        '''
+        The file as a RawFile if filtering would not change it
+        The file is read once: the blocks checked are the bytes spooled,
+        so nothing written to it after the check reaches the archive
+        '''
+        spool = None
+        raw = None
+        try:
+            with open(self.real_path, 'rb') as source:
+                info = os.fstat(source.fileno())
+                # /proc files report 0 bytes and /sys files 4096, whatever
+                # they hold, only regular files' sizes can be trusted
+                if not stat.S_ISREG(info.st_mode) or self._pseudo_file():
+                    return None
+                size = info.st_size
+                # files over a limit are truncated on the filtered path
+                if self.output_limit is not None and size > self.output_limit:
+                    return None
+                spool = tempfile.TemporaryFile(dir=self.spool_dir)
+                if not spec_filter.passes_through(source, spool):
+                    return None
+                after = os.fstat(source.fileno())
+            # the size is what was read, and the file didn't change
+            # while it was
+            if (spec_filter.bytes_read != size or after.st_size != size or
+                    after.st_mtime != info.st_mtime):
+                logger.debug('%s changed while read or reports %d bytes and holds %d',
+                             self.real_path, size, spec_filter.bytes_read)
+                return None
+            if self.output_budget is not None:
+                taken = self.output_budget.take(size)
+                if taken < size:
+                    self.output_budget.give(taken)
+                    return None
+            spool.seek(0)
+            raw = RawFile(spool, size)
+            return raw
+        except (IOError, OSError) as err:
+            logger.debug('Could not check %s: %s', self.real_path, err)
+            return None
+        finally:
+            if spool is not None and raw is None:
+                spool.close()
+
     def get_output(self):
         '''
         Get file content, selecting only lines we are interested in
         '''
-        if not os.path.isfile(self.real_path):
+        start = time.time()
+        if not EXPANDER.is_file(self.real_path):
             logger.debug('File %s does not exist', self.real_path)
+            self._record_stats(start, 'missing')
             return
 
         logger.debug('Copying %s to %s with filters %s',
                      self.real_path, self.archive_path, str(self.pattern))
 
-        cmd = []
-        cmd.append("/bin/sed".encode('utf-8'))
-        cmd.append("-rf".encode('utf-8'))
-        cmd.append(constants.default_sed_file.encode('utf-8'))
-        cmd.append(self.real_path.encode('utf8'))
-        sedcmd = Popen(cmd,
-                       stdout=PIPE)
-
-        if self.exclude is not None:
-            exclude_file = NamedTemporaryFile()
-            exclude_file.write("\n".join(self.exclude))
-            exclude_file.flush()
-
-            cmd = "/bin/grep -v -F -f %s" % exclude_file.name
-            args = shlex.split(cmd.encode("utf-8"))
-            proc = Popen(args, stdin=sedcmd.stdout, stdout=PIPE)
-            sedcmd.stdout.close()
-            stdin = proc.stdout
-            if self.pattern is None:
-                output = proc.communicate()[0]
-            else:
-                sedcmd = proc
-
-        if self.pattern is not None:
-            pattern_file = NamedTemporaryFile()
-            pattern_file.write("\n".join(self.pattern))
-            pattern_file.flush()
-
-            cmd = "/bin/grep -F -f %s" % pattern_file.name
-            args = shlex.split(cmd.encode("utf-8"))
-            proc1 = Popen(args, stdin=sedcmd.stdout, stdout=PIPE)
-            sedcmd.stdout.close()
-
-            if self.exclude is not None:
-                stdin.close()
-
-            output = proc1.communicate()[0]
-
-        if self.pattern is None and self.exclude is None:
-            output = sedcmd.communicate()[0]
+        spec_filter = self.get_filter()
+        if self.raw_copy:
+            raw = self._raw_file(spec_filter)
+            if raw:
+                logger.debug('Copying %s unfiltered', self.real_path)
+                self._record_stats(start, 'ok', spec_filter=spec_filter, output=raw)
+                return raw
+        try:
+            with open(self.real_path, 'rb') as source:
+                output = spec_filter.apply(source)
+        except IOError as err:
+            logger.debug('Could not read %s: %s', self.real_path, err)
+            self._record_stats(start, 'error')
+            return
 
+        self._record_stats(start, 'ok', spec_filter=spec_filter, output=output)
         return output.decode('utf-8', 'ignore').strip()
@@ -0,0 +1,56 @@
+"""
+Streaming multipart/form-data bodies
+"""
+import os
+import uuid
+from io import BytesIO
+
+
+class MultipartFile(object):
+    '''
+    A multipart/form-data body holding one file, read from disk in blocks
+    as it is sent, so uploading it takes the same memory at any size
+    Pass it as data, with content_type and len() as the request's
+    Content-Type and Content-Length
+    '''
+    def __init__(self, field, path, filename=None, content_type='application/octet-stream'):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        if filename is None:
+            filename = os.path.basename(path)
+        head = ('--%s\r\n'
+                'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                'Content-Type: %s\r\n'
+                '\r\n' % (boundary, field, filename, content_type))
+        tail = '\r\n--%s--\r\n' % boundary
+        self.head = head.encode('utf-8')
+        self.tail = tail.encode('utf-8')
+        self.path = path
+        self.size = len(self.head) + os.path.getsize(path) + len(self.tail)
+        self._parts = None
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        '''
+        Up to size bytes of the body, all of what's left if size is negative
+        '''
+        if self._parts is None:
+            self._parts = [BytesIO(self.head), open(self.path, 'rb'),
+                           BytesIO(self.tail)]
+        chunks = []
+        while self._parts and size != 0:
+            data = self._parts[0].read(size)
+            if not data:
+                self._parts.pop(0).close()
+                continue
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+        return b''.join(chunks)
+
+    def close(self):
+        for part in self._parts or []:
+            part.close()
+        self._parts = []
@@ -0,0 +1,151 @@
+"""
+Wildcard and glob expansion over a per-run cache of directory listings
+"""
+import os
+import re
+import fnmatch
+import logging
+from constants import InsightsConstants as constants
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger(constants.app_name)
+
+_MAGIC = re.compile('[*?[]')
+
+
+class _Entry(object):
+    '''
+    Stand-in for scandir's DirEntry when only os.listdir is available,
+    stat'ing lazily and at most once
+    '''
+    def __init__(self, dir_name, name):
+        self.name = name
+        self.path = os.path.join(dir_name, name)
+        self._is_dir = None
+        self._is_file = None
+
+    def is_dir(self):
+        if self._is_dir is None:
+            self._is_dir = os.path.isdir(self.path)
+        return self._is_dir
+
+    def is_file(self):
+        if self._is_file is None:
+            self._is_file = os.path.isfile(self.path)
+        return self._is_file
+
+
+class PathExpander(object):
+    '''
+    Expands wildcarded spec paths, listing each directory once
+    Expansions return DirEntry-like entries, whose is_file() and is_dir()
+    come from the listing where the platform's scandir provides them
+    '''
+    def __init__(self):
+        self._listings = {}
+        self._regexes = {}
+
+    def reset(self):
+        '''
+        Forget the listings, at the start of each collection run
+        '''
+        self._listings = {}
+
+    def listing(self, dir_name):
+        '''
+        Entries of dir_name by name, None if it can't be listed
+        '''
+        if dir_name not in self._listings:
+            entries = None
+            try:
+                if scandir is not None:
+                    entries = dict((e.name, e) for e in scandir(dir_name))
+                else:
+                    entries = dict((name, _Entry(dir_name, name))
+                                   for name in os.listdir(dir_name))
+            except OSError:
+                pass
+            self._listings[dir_name] = entries
+        return self._listings[dir_name]
+
+    def _compile(self, pattern, translate=False):
+        key = (pattern, translate)
+        if key not in self._regexes:
+            self._regexes[key] = re.compile(fnmatch.translate(pattern) if translate
+                                            else pattern)
+        return self._regexes[key]
+
+    def expand(self, path):
+        '''
+        Entries of the directory of path whose names match the basename
+        of path as a regular expression, None if the directory is missing
+        '''
+        dir_name = os.path.dirname(path)
+        entries = self.listing(dir_name)
+        if entries is None:
+            return None
+        match = self._compile(os.path.basename(path)).match
+        return [entries[name] for name in sorted(entries) if match(name)]
+
+    def glob(self, pattern):
+        '''
+        Entries matching a shell glob, as glob.glob would find them
+        '''
+        if not _MAGIC.search(pattern):
+            if os.path.lexists(pattern):
+                return [_Entry(os.path.dirname(pattern), os.path.basename(pattern))]
+            return []
+        dir_name, base = os.path.split(pattern)
+        if not dir_name:
+            dirs = [os.curdir]
+        elif dir_name != pattern and _MAGIC.search(dir_name):
+            dirs = [e.path for e in self.glob(dir_name) if e.is_dir()]
+        else:
+            dirs = [dir_name]
+        matches = []
+        for d in dirs:
+            if not base:
+                # a trailing separator only matches directories
+                if os.path.isdir(d):
+                    matches.append(_Entry(d, base))
+                continue
+            if not _MAGIC.search(base):
+                if os.path.lexists(os.path.join(d, base)):
+                    matches.append(_Entry(d, base))
+                continue
+            entries = self.listing(d)
+            if not entries:
+                continue
+            match = self._compile(base, translate=True).match
+            for name in sorted(entries):
+                # like glob, wildcards don't match hidden files
+                if name[0] == '.' and base[0] != '.':
+                    continue
+                if match(name):
+                    entry = entries[name]
+                    if not dir_name:
+                        entry = _Entry('', name)
+                    matches.append(entry)
+        return matches
+
+    def is_file(self, path):
+        '''
+        os.path.isfile, answered from a listing when there is one
+        '''
+        entries = self._listings.get(os.path.dirname(path))
+        if entries:
+            entry = entries.get(os.path.basename(path))
+            if entry is not None:
+                return entry.is_file()
+        return os.path.isfile(path)
+
+
+# shared by every expansion of a run, reset by DataCollector.run_collection
+EXPANDER = PathExpander()
@@ -0,0 +1,123 @@
+"""
+Profile a client run without disturbing its output
+"""
+import os
+import sys
+import time
+import threading
+import logging
+from constants import InsightsConstants as constants
+
+logger = logging.getLogger(constants.app_name)
+
+PROFILE_MODES = ('cprofile', 'sample')
+# seconds between stack samples
+DEFAULT_INTERVAL = 0.01
+
+
+def _open_private(path):
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, int('0600', 8)), 'w')
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class StackSampler(object):
+    '''
+    Count the Python stacks of every thread every interval seconds
+    Stacks are written in the collapsed format flamegraph.pl reads,
+    one "frame;frame;frame count" line per distinct stack, root first
+    '''
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        me = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.reverse()
+            key = ';'.join(stack)
+            self.counts[key] = self.counts.get(key, 0) + 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='insights-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, path):
+        with _open_private(path) as output:
+            for stack, count in sorted(self.counts.items()):
+                output.write('%s %d\n' % (stack, count))
+
+
+class Profiler(object):
+    '''
+    Profile the client in one of PROFILE_MODES, writing the result
+    to a timestamped file in directory when stopped
+    cprofile writes pstats output of the main thread, sample writes
+    collapsed stacks of all threads
+    '''
+    def __init__(self, mode, directory=constants.log_dir, interval=DEFAULT_INTERVAL):
+        self.mode = mode
+        self.directory = directory
+        self.interval = interval
+        self.path = None
+        self._profiler = None
+
+    def start(self):
+        stamp = time.strftime('%Y%m%d%H%M%S')
+        if self.mode == 'cprofile':
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self.path = os.path.join(self.directory,
+                                     'profile-%s-%d.pstats' % (stamp, os.getpid()))
+            self._profiler.enable()
+        else:
+            self._profiler = StackSampler(self.interval)
+            self.path = os.path.join(self.directory,
+                                     'profile-%s-%d.collapsed' % (stamp, os.getpid()))
+            self._profiler.start()
+        logger.debug('Profiling with %s to %s', self.mode, self.path)
+
+    def stop(self):
+        '''
+        Stop profiling and write the output, safe to call more than once
+        '''
+        if self._profiler is None:
+            return
+        profiler, self._profiler = self._profiler, None
+        try:
+            if self.mode == 'cprofile':
+                profiler.disable()
+                profiler.create_stats()
+                import marshal
+                with _open_private(self.path) as output:
+                    marshal.dump(profiler.stats, output)
+            else:
+                profiler.stop()
+                profiler.write(self.path)
+            logger.debug('Wrote profile to %s', self.path)
+        except (IOError, OSError) as err:
+            logger.error('Could not write profile to %s: %s', self.path, err)
@@ -0,0 +1,102 @@
+"""
+Retrying requests to the Insights service
+"""
+import time
+import random
+import logging
+from email.utils import parsedate_tz, mktime_tz
+import requests
+from constants import InsightsConstants as constants
+
+logger = logging.getLogger(constants.app_name)
+
+APP_NAME = constants.app_name
+# worth trying again besides 5xx: request timeout, too many requests
+RETRYABLE_STATUSES = (408, 429)
+
+
+def retry_after(response):
+    '''
+    Seconds a response's Retry-After header asks to wait, None if it has none
+    '''
+    value = response.headers.get('retry-after') if response is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time.time())
+
+
+class RetryPolicy(object):
+    '''
+    How many times to try a request, which failures to try again and
+    how long to wait in between
+    Connection errors, 5xx, 408 and 429 responses are retried, other
+    responses are final.  Waits are drawn uniformly between 0 and an
+    exponentially growing ceiling (full jitter), so hosts failing at the
+    same moment don't all retry at the same moment, unless the server
+    asks for a Retry-After
+    '''
+    def __init__(self, attempts=1, base_delay=30, max_delay=constants.sleep_time,
+                 sleep=time.sleep, rand=random.random):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.rand = rand
+
+    @classmethod
+    def from_config(cls, config, attempts):
+        try:
+            base_delay = config.getfloat(APP_NAME, 'retry_base_delay')
+            max_delay = config.getfloat(APP_NAME, 'retry_max_delay')
+        except ValueError:
+            logger.warn('WARNING: Invalid retry_base_delay or retry_max_delay, '
+                        'using the defaults')
+            return cls(attempts)
+        return cls(attempts, base_delay, max_delay)
+
+    def retryable(self, response=None):
+        '''
+        Whether a response, or a connection error when None, is worth
+        trying again
+        '''
+        if response is None:
+            return True
+        return response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES
+
+    def delay(self, attempt, response=None):
+        '''
+        Seconds to wait after the attempt-th failed attempt, counting from 0
+        '''
+        requested = retry_after(response)
+        if requested is not None:
+            return min(requested, self.max_delay)
+        return self.rand() * min(self.max_delay, self.base_delay * 2 ** attempt)
+
+    def call(self, request, description='request'):
+        '''
+        The response of request(), tried again while it fails in a
+        retryable way and attempts are left
+        The last response is returned and the last connection error
+        raised once attempts run out
+        '''
+        for attempt in range(self.attempts):
+            response = None
+            try:
+                response = request()
+            except requests.exceptions.RequestException as err:
+                if attempt + 1 == self.attempts:
+                    raise
+                logger.debug('%s failed: %s', description, err)
+            else:
+                if attempt + 1 == self.attempts or not self.retryable(response):
+                    return response
+                logger.debug('%s failed: %s', description, response.status_code)
+            wait = self.delay(attempt, response)
+            logger.debug('Retrying %s in %.1f seconds', description, wait)
+            self.sleep(wait)
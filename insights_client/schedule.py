@@ -2,29 +2,172 @@
 Module responsible for scheduling Insights data collection
 """
 import os
+import hashlib
 import logging
+from subprocess import call
 from client_config import InsightsClient
 from constants import InsightsConstants as constants
+from utilities import generate_machine_id
 
 CRON_DAILY = '/etc/cron.daily/'
 CRON_WEEKLY = '/etc/cron.weekly/'
+CRON_D = '/etc/cron.d/'
+SYSTEMD_DIR = '/etc/systemd/system/'
+SYSTEMD_RUNNING = '/run/systemd/system'
 APP_NAME = constants.app_name
+DAY = 24 * 60 * 60
 logger = logging.getLogger(APP_NAME)
 
+SERVICE_UNIT = '''[Unit]
+Description=Insights collection and upload
+Wants=network-online.target
+After=network-online.target
+
+[Service]
+Type=oneshot
+ExecStart=%(script)s
+'''
+
+TIMER_UNIT = '''[Unit]
+Description=Daily Insights collection and upload
+
+[Timer]
+OnCalendar=*-*-* %(clock)s
+RandomizedDelaySec=%(jitter)d
+Persistent=true
+
+[Install]
+WantedBy=timers.target
+'''
+
+
+def splay_offset(machine_id, window):
+    '''
+    Seconds into a window of the given length this machine runs at
+    The offset is a hash of the machine-id, the same every time for a
+    machine and spread evenly over the window across machines
+    '''
+    if window <= 0:
+        return 0
+    return int(hashlib.sha256(machine_id.encode('utf-8')).hexdigest(), 16) % window
+
+
+def _parse_start(start):
+    '''
+    Seconds after midnight of an HH:MM time
+    '''
+    hours, minutes = start.strip().split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(start)
+    return hours * 3600 + minutes * 60
+
 
 class InsightsSchedule(object):
     """
     Set the cron schedule
+    With schedule_window set, run daily at a time within the window
+    derived from the machine-id, through a systemd timer or a cron.d
+    entry, instead of with the rest of cron.daily
     """
     def __init__(self, set_cron=True):
-        if set_cron and not self.already_linked():
-            self.set_daily()
+        self.splay = None
+        if set_cron:
+            self.splay = self._splay_config()
+            if not self._up_to_date():
+                self.set_daily()
+
+    def _splay_config(self):
+        '''
+        (seconds after midnight to run at, seconds of jitter), None when
+        running from cron.daily
+        '''
+        try:
+            window = InsightsClient.config.getint(APP_NAME, 'schedule_window')
+            start = _parse_start(InsightsClient.config.get(APP_NAME, 'schedule_start'))
+            jitter = InsightsClient.config.getint(APP_NAME, 'schedule_jitter')
+        except ValueError:
+            logger.warn('WARNING: Invalid schedule_window, schedule_start or schedule_jitter, '
+                        'scheduling with cron.daily')
+            return None
+        if window <= 0:
+            return None
+        offset = splay_offset(generate_machine_id(), min(window, DAY))
+        logger.debug('Schedule offset %d seconds into a %d second window', offset, window)
+        return (start + offset) % DAY, max(0, jitter)
+
+    def _script(self):
+        return ('/etc/' + APP_NAME + '/' + APP_NAME + (
+            '-container' if InsightsClient.options.container_mode else ''
+        ) + '.cron')
+
+    def _systemd(self):
+        return os.path.isdir(SYSTEMD_RUNNING)
+
+    def _units(self):
+        '''
+        {path: content} of the systemd service and timer running at the splay
+        '''
+        at, jitter = self.splay
+        clock = '%02d:%02d:%02d' % (at // 3600, at // 60 % 60, at % 60)
+        return {SYSTEMD_DIR + APP_NAME + '.service': SERVICE_UNIT % {'script': self._script()},
+                SYSTEMD_DIR + APP_NAME + '.timer': TIMER_UNIT % {'clock': clock,
+                                                                 'jitter': jitter}}
+
+    def _cron_entry(self):
+        '''
+        cron.d entry running at the splay, cron's minutes made up for
+        and jitter added by sleeping first
+        '''
+        at, jitter = self.splay
+        command = self._script()
+        if jitter:
+            # bash's RANDOM is 15 bits, two make up to 9 days
+            command = 'sleep $((%d + ((RANDOM << 15) | RANDOM) \\%% %d)); %s' % (
+                at % 60, jitter + 1, command)
+        elif at % 60:
+            command = 'sleep %d; %s' % (at % 60, command)
+        return ('SHELL=/bin/bash\n'
+                '%d %d * * * root %s\n' % (at // 60 % 60, at // 3600, command))
+
+    def _wanted(self):
+        '''
+        {path: content} of the files scheduling with a splay
+        '''
+        if self._systemd():
+            return self._units()
+        return {CRON_D + APP_NAME: self._cron_entry()}
+
+    def _splayed(self):
+        '''
+        Paths of the systemd timer and cron.d entry, the installed ones
+        '''
+        return [path for path in (SYSTEMD_DIR + APP_NAME + '.timer', CRON_D + APP_NAME)
+                if os.path.isfile(path)]
+
+    def _up_to_date(self):
+        '''
+        Whether the installed schedule is the configured one
+        '''
+        if not self.splay:
+            return not self._splayed() and self.already_linked()
+        for path, content in self._wanted().items():
+            try:
+                with open(path) as installed:
+                    if installed.read() != content:
+                        return False
+            except IOError:
+                return False
+        return True
 
     def already_linked(self):
         """
         Determine if we are already scheduled
         """
-        if os.path.isfile(CRON_WEEKLY + APP_NAME):
+        if self._splayed():
+            logger.debug('Found splayed schedule')
+            return True
+        elif os.path.isfile(CRON_WEEKLY + APP_NAME):
             logger.debug('Found cron.weekly')
             return True
         elif os.path.isfile(CRON_DAILY + APP_NAME):
@@ -37,26 +180,73 @@ class InsightsSchedule(object):
         """
         Set cron task to daily
         """
+        if self.splay:
+            return self.set_splayed()
         logger.debug('Setting schedule to daily')
+        self._remove_splayed()
         try:
             os.remove(CRON_WEEKLY + APP_NAME)
         except OSError:
             logger.debug('Could not remove cron.weekly')
 
         try:
-            os.symlink(
-                '/etc/' + APP_NAME + '/' + APP_NAME + (
-                    '-container' if InsightsClient.options.container_mode else ''
-                ) + '.cron',
-                CRON_DAILY + APP_NAME)
+            os.symlink(self._script(), CRON_DAILY + APP_NAME)
         except OSError:
             logger.debug('Could not link cron.daily')
 
+    def set_splayed(self):
+        '''
+        Install the systemd timer or cron.d entry running at the splay
+        '''
+        logger.debug('Setting schedule to daily with a splay')
+        self.remove_scheduling()
+        wanted = self._wanted()
+        for path, content in wanted.items():
+            try:
+                with open(path, 'w') as unit:
+                    unit.write(content)
+            except IOError as err:
+                logger.error('Could not write %s: %s', path, err)
+                return
+        if self._systemd():
+            self._systemctl('daemon-reload')
+            self._systemctl('enable', APP_NAME + '.timer')
+            self._systemctl('start', APP_NAME + '.timer')
+
+    def _systemctl(self, *args):
+        try:
+            with open(os.devnull, 'w') as devnull:
+                rc = call(('systemctl',) + args, stdout=devnull, stderr=devnull)
+        except OSError as err:
+            rc = err
+        if rc:
+            logger.debug('systemctl %s failed: %s', ' '.join(args), rc)
+
+    def _remove_splayed(self):
+        timer = SYSTEMD_DIR + APP_NAME + '.timer'
+        if os.path.isfile(timer):
+            self._systemctl('stop', APP_NAME + '.timer')
+            self._systemctl('disable', APP_NAME + '.timer')
+        removed = False
+        for path in (timer, SYSTEMD_DIR + APP_NAME + '.service'):
+            try:
+                os.remove(path)
+                removed = True
+            except OSError:
+                pass
+        if removed and self._systemd():
+            self._systemctl('daemon-reload')
+        try:
+            os.remove(CRON_D + APP_NAME)
+        except OSError:
+            pass
+
     def remove_scheduling(self):
         '''
         Delete cron tasks
         '''
         logger.debug('Removing all cron tasks')
+        self._remove_splayed()
         try:
             os.remove(CRON_WEEKLY + APP_NAME)
         except OSError:
@@ -35,6 +35,23 @@ import struct, socket
 import tempfile
 import logging
 import tarfile
+import multiprocessing
+
+# the cleaner forked worker processes work with, set before each pool starts
+_pool_cleaner = None
+
+
+def _discover_file(f):
+    '''returns the IPs and hostnames in a file that are missing from the databases, in the order they are met'''
+    _pool_cleaner.misses = []
+    _pool_cleaner._clean_file(f, write=False)
+    return _pool_cleaner.misses
+
+
+def _rewrite_file(f):
+    '''cleans a file with the databases as they were when the pool started, False if something was missing'''
+    _pool_cleaner.misses = []
+    return _pool_cleaner._clean_file(f)
 
 
 class SOSCleaner:
@@ -58,15 +75,19 @@ class SOSCleaner:
 
         # IP obfuscation information
         self.ip_db = dict() #IP database
+        self.ip_rdb = dict() #reverse IP database, original to obfuscated
+        self.last_ip = None #last obfuscated IP handed out
         self.start_ip = '10.230.230.1'
 
         # Hostname obfuscation information
         self.hn_db = dict() #hostname database
+        self.hn_rdb = dict() #reverse hostname database, original to obfuscated
         self.hostname_count = 0
         self.hostname = None
 
         # Domainname obfuscation information
         self.dn_db = dict() #domainname database
+        self.dn_regex = None #matches a hostname in any domain of the database
         self.root_domain = 'example.com' #right now this needs to be a 2nd level domain, like foo.com, example.com, domain.org, etc.
 
         # self.origin_path, self.dir_path, self.session, self.logfile, self.uuid = self._prep_environment()
@@ -77,6 +98,11 @@ class SOSCleaner:
         self.kw_db = dict() #keyword database
         self.kw_count = 0
 
+        # Parallel cleaning
+        self.workers = 1
+        self.frozen = False #databases are read-only, unknown values are recorded in misses instead
+        self.misses = list()
+
         if magic:
             self.magic = magic.open(magic.MAGIC_NONE)
             self.magic.load()
@@ -294,10 +320,8 @@ class SOSCleaner:
         Example:
         '''
         try:
-            for od,d in self.dn_db.items():
-                #regex = re.compile(r'\w*\.%s' % d)
-                regex = re.compile(r'(?![\W\-\:\ \.])[a-zA-Z0-9\-\_\.]*\.%s' % d)
-                hostnames = [each for each in regex.findall(line)]
+            if self.dn_regex:
+                hostnames = [each for each in self.dn_regex.findall(line)]
                 if len(hostnames) > 0:
                     for hn in hostnames:
                         new_hn = self._hn2db(hn)
@@ -359,14 +383,17 @@ class SOSCleaner:
         except Exception, e:    #pragma: no cover
             self.logger.exception(e)
 
-    def _process_hosts_file(self):
+    def _process_hosts_file(self, root=None):
         # this will process the hosts file more thoroughly to try and capture as many server short names/aliases as possible
         # could lead to false positives if people use dumb things for server aliases, like 'file' or 'server' or other common terms
         # this may be an option that can be enabled... --hosts or similar?
+        # root is the directory holding etc/hosts, the working directory by default
 
+        if root is None:
+            root = self.dir_path
         try:
-            if os.path.isfile(os.path.join(self.dir_path, 'etc/hosts')):
-                with open(os.path.join(self.dir_path, 'etc/hosts')) as f:
+            if os.path.isfile(os.path.join(root, 'etc/hosts')):
+                with open(os.path.join(root, 'etc/hosts')) as f:
                     self.logger.con_out("Processing hosts file for better obfuscation coverage")
                     data = f.readlines()
                     for line in data:
@@ -402,11 +429,21 @@ class SOSCleaner:
                     self.logger.con_out("Obfuscated Domain Created - %s" % o_domain)
 
             self.domain_count = len(self.dn_db)
+            self._compile_domains()
             return True
 
         except Exception, e: # pragma: no cover
             self.logger.exception(e)
 
+    def _compile_domains(self):
+        #builds one regex matching hostnames in any of the domains, so each line is only scanned once
+        #longer domains come first so the most specific one wins
+        if self.dn_db:
+            domains = sorted(set(self.dn_db.values()), key=len, reverse=True)
+            self.dn_regex = re.compile(r'(?![\W\-\:\ \.])[a-zA-Z0-9\-\_\.]*\.(?:%s)' % '|'.join(domains))
+        else:
+            self.dn_regex = None
+
     def _keywords2db(self):
         #processes optional keywords to add to be obfuscated
         try:
@@ -503,20 +540,20 @@ class SOSCleaner:
         '''
 
         ip_num = self._ip2int(ip)
-        ip_found = False
         db = self.ip_db
-        for k,v in db.iteritems():
-            if v == ip_num:
-                ret_ip = self._int2ip(k)
-                ip_found = True
-        if ip_found:                #the entry already existed
-            return ret_ip
+        if ip_num in self.ip_rdb:   #the entry already existed
+            return self._int2ip(self.ip_rdb[ip_num])
+        elif self.frozen:           #leave it to the coordinator
+            self.misses.append(('ip', ip))
+            return ip
         else:                       #the entry did not already exist
             if len(self.ip_db) > 0:
-                new_ip = max(db.keys()) + 1
+                new_ip = self.last_ip + 1
             else:
                 new_ip = self._ip2int(self.start_ip)
             db[new_ip] = ip_num
+            self.ip_rdb[ip_num] = new_ip
+            self.last_ip = new_ip
 
             return self._int2ip(new_ip)
 
@@ -524,14 +561,11 @@ class SOSCleaner:
         '''
         This will add a hostname for a hostname for an included domain or return an existing entry
         '''
-        db = self.hn_db
-        hn_found = False
-        for k,v in db.iteritems():
-            if v == hn:  #the hostname is in the database
-                ret_hn = k
-                hn_found = True
-        if hn_found:
-            return ret_hn
+        if hn in self.hn_rdb:  #the hostname is in the database
+            return self.hn_rdb[hn]
+        elif self.frozen:       #leave it to the coordinator
+            self.misses.append(('hn', hn))
+            return hn
         else:
             self.hostname_count += 1    #we have a new hostname, so we increment the counter to get the host ID number
             o_domain = self.root_domain
@@ -540,6 +574,7 @@ class SOSCleaner:
                     o_domain = od
             new_hn = "host%s.%s" % (self.hostname_count, o_domain)
             self.hn_db[new_hn] = hn
+            self.hn_rdb[hn] = new_hn
 
             return new_hn
 
@@ -580,38 +615,90 @@ class SOSCleaner:
 
         return new_line
 
-    def _clean_file(self, f):
+    def _clean_file(self, f, write=True):
         '''this will take a given file path, scrub it accordingly, and save a new copy of the file
-        in the same location'''
+        in the same location
+        lines are streamed into a sibling file that is then renamed over the original, so memory
+        use doesn't grow with the file size and the data is only written once
+        returns False when the databases are frozen and something was missing from them, the file is left alone'''
         if os.path.exists(f) and not os.path.islink(f):
-            tmp_file = tempfile.TemporaryFile()
             try:
                 fh = open(f,'r')
-                data = fh.readlines()
-                fh.close()
-                if len(data) > 0: #if the file isn't empty:
-                    for l in data:
-                        new_l = self._clean_line(l)
-                        tmp_file.write(new_l)
-
-                    tmp_file.seek(0)
-
             except Exception, e: # pragma: no cover
                 self.logger.exception(e)
                 raise Exception("CleanFile Error: Cannot Open File For Reading - %s" % f)
 
+            if not write:   # only looking for what's missing from the databases
+                try:
+                    for l in fh:
+                        self._clean_line(l)
+                finally:
+                    fh.close()
+                return not self.misses
+
+            tmp_path = None
             try:
-                if len(data) > 0:
-                    new_fh = open(f, 'w')
-                    for line in tmp_file:
-                        new_fh.write(line)
-                    new_fh.close()
+                tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(f),
+                                                    prefix='.%s.' % os.path.basename(f))
+                with os.fdopen(tmp_fd, 'w') as new_fh:
+                    for l in fh:
+                        new_fh.write(self._clean_line(l))
+                if self.misses:
+                    os.remove(tmp_path)
+                    return False
+                shutil.copymode(f, tmp_path)
+                os.rename(tmp_path, f)
             except Exception, e: # pragma: no cover
                 self.logger.exception(e)
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
                 raise Exception("CleanFile Error: Cannot Write to New File - %s" % f)
 
             finally:
-                tmp_file.close()
+                fh.close()
+        return True
+
+    def _clean_files_parallel(self, files):
+        '''
+        cleans files in worker processes while keeping the databases identical to a serial run
+        1. workers find the IPs and hostnames each file needs, without assigning anything
+        2. we assign them in file order, exactly as cleaning the files one by one would
+        3. workers rewrite the files with the now complete, read-only databases
+        a file that still needed something new in 3 is cleaned again here, after the others
+        '''
+        global _pool_cleaner
+        self.logger.con_out("Cleaning files with %s workers", self.workers)
+        _pool_cleaner = self
+        self.frozen = True
+        try:
+            pool = multiprocessing.Pool(self.workers)
+            try:
+                discovered = pool.map(_discover_file, files)
+            finally:
+                pool.close()
+                pool.join()
+            self.frozen = False
+            for misses in discovered:
+                for kind, value in misses:
+                    if kind == 'ip':
+                        self._ip2db(value)
+                    else:
+                        self._hn2db(value)
+            self.frozen = True
+            pool = multiprocessing.Pool(self.workers)
+            try:
+                cleaned = pool.map(_rewrite_file, files)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            self.frozen = False
+            self.misses = list()
+            _pool_cleaner = None
+        for f, done in zip(files, cleaned):
+            if not done:
+                self.logger.debug("Cleaning %s again", f)
+                self._clean_file(f)
 
     def _add_extra_files(self, files):
         '''if extra files are to be analyzed with an sosreport, this will add them to the origin path to be analyzed'''
@@ -652,6 +739,66 @@ class SOSCleaner:
             self.logger.exception(e)
             raise Exception("CleanFilesOnlyError: unable to process")
 
+    def start_inline(self, options, hostname=None, root='/'): # pragma: no cover
+        '''prepares to clean data as it is collected with clean_text, rather than an extracted sosreport
+        hostname is what the report's hostname file would hold, root is where to find etc/hosts'''
+
+        if options.report_dir: # override the default location for artifacts (/tmp)
+            if os.path.isdir(options.report_dir):
+                self.report_dir = options.report_dir
+        self.origin_path, self.dir_path, self.session, self.logfile, self.uuid = self._prep_environment()
+        self.origin_path = None # nothing is extracted or copied
+        self.dir_path = None
+        self.file_count = 0
+        self._start_logging(self.logfile)
+        self._get_disclaimer()
+        if options.domains:
+            self.domains = options.domains
+        if options.keywords:
+            self.keywords = options.keywords
+            self._keywords2db()
+        if hostname:
+            name_list = hostname.rstrip().split('.')
+            self.hostname = name_list[0]
+            if len(name_list) > 1:
+                self.domainname = '.'.join(name_list[1:len(name_list)])
+            self.hn_db['host0'] = self.hostname
+            self.hn_rdb[self.hostname] = 'host0'
+        self._process_hosts_file(root)
+        self._domains2db()
+        self.logger.con_out("IP Obfuscation Start Address - %s", self.start_ip)
+        self.logger.con_out("*** SOSCleaner Processing ***")
+
+    def clean_text(self, data):
+        '''returns the contents of a whole file, cleaned'''
+        self.file_count += 1
+        encoded = isinstance(data, unicode)
+        if encoded:
+            data = data.encode('utf-8')
+        data = ''.join([self._clean_line(l) for l in data.splitlines(True)])
+        if encoded:
+            data = data.decode('utf-8', 'ignore')
+        return data
+
+    def finish_inline(self): # pragma: no cover
+        '''writes the reports once everything has gone through clean_text'''
+        self.logger.con_out("*** SOSCleaner Statistics ***")
+        self.logger.con_out("IP Addresses Obfuscated - %s", len(self.ip_db))
+        self.logger.con_out("Hostnames Obfuscated - %s" , len(self.hn_db))
+        self.logger.con_out("Domains Obfuscated - %s" , len(self.dn_db))
+        self.logger.con_out("Total Files Analyzed - %s", self.file_count)
+        self.logger.con_out("*** SOSCleaner Artifacts ***")
+        self._create_reports()
+        self.logger.con_out('SOSCleaner Complete')
+
+        return_data = [self.logfile, self.ip_report]
+        if self.hostname:
+            return_data.append(self.hn_report)
+        if len(self.dn_db) >= 1:
+            return_data.append(self.dn_report)
+
+        return return_data
+
     def clean_report(self, options, sosreport): # pragma: no cover
         '''this is the primary function, to put everything together and analyze an sosreport'''
 
@@ -666,6 +813,8 @@ class SOSCleaner:
         if options.keywords:
             self.keywords = options.keywords
             self._keywords2db()
+        if getattr(options, 'workers', None):
+            self.workers = options.workers
         if not sosreport:
             if not options.files:
                 raise Exception("Error: You must supply either an sosreport and/or files to process")
@@ -686,6 +835,7 @@ class SOSCleaner:
 
             if self.hostname:   # if we have a hostname that's not a None type
                 self.hn_db['host0'] = self.hostname     # we'll prime the hostname pump to clear out a ton of useless logic later
+                self.hn_rdb[self.hostname] = 'host0'
 
             self._process_hosts_file()  # we'll take a dig through the hosts file and make sure it is as scrubbed as possible
 
@@ -694,9 +844,12 @@ class SOSCleaner:
         self.logger.con_out("IP Obfuscation Start Address - %s", self.start_ip)
         self.logger.con_out("*** SOSCleaner Processing ***")
         self.logger.info("Working Directory - %s", self.dir_path)
-        for f in files:
-            self.logger.debug("Cleaning %s", f)
-            self._clean_file(f)
+        if self.workers > 1 and len(files) > 1:
+            self._clean_files_parallel(files)
+        else:
+            for f in files:
+                self.logger.debug("Cleaning %s", f)
+                self._clean_file(f)
         self.logger.con_out("*** SOSCleaner Statistics ***")
         self.logger.con_out("IP Addresses Obfuscated - %s", len(self.ip_db))
         self.logger.con_out("Hostnames Obfuscated - %s" , len(self.hn_db))
@@ -0,0 +1,177 @@
+"""
+Run collection commands without getting in the way of the host's workload
+"""
+import os
+import errno
+import itertools
+import logging
+from subprocess import Popen, PIPE, STDOUT
+from distutils.spawn import find_executable
+from constants import InsightsConstants as constants
+
+logger = logging.getLogger(constants.app_name)
+
+APP_NAME = constants.app_name
+IONICE_CLASSES = {'best-effort': '2', 'idle': '3'}
+CGROUP_ROOT = '/sys/fs/cgroup'
+# run as sh -c JOIN_CGROUP cgroup command...
+JOIN_CGROUP = '{ echo $$ > "$0/cgroup.procs"; } 2>/dev/null; exec "$@"'
+
+
+def _usable(name, args, what):
+    '''
+    The command line prefix running a command through name with args,
+    empty if that doesn't work here, as ionice doesn't in some containers
+    Checked once up front so the complaint isn't collected with every
+    command's output
+    '''
+    path = find_executable(name)
+    if path is not None:
+        prefix = [path] + args
+        # ionice warns without failing for some errors
+        probe = Popen(prefix + ['true'], stdout=PIPE, stderr=STDOUT)
+        complaint = probe.communicate()[0]
+        if probe.returncode == 0 and not complaint:
+            return prefix
+        logger.debug('%s: %s', ' '.join(prefix), complaint.strip())
+    logger.warn('WARNING: %s not usable, not changing %s', name, what)
+    return []
+
+
+def _write(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+class MemoryCgroups(object):
+    '''
+    A memory cgroup for each command, under an insights-client cgroup
+    Uses the unified (v2) hierarchy when it is mounted, else the v1
+    memory controller
+    '''
+    def __init__(self, limit, root=CGROUP_ROOT):
+        self.limit = limit
+        self._names = itertools.count()
+        if os.path.exists(os.path.join(root, 'cgroup.controllers')):
+            self.base = os.path.join(root, APP_NAME)
+            self.limit_file = 'memory.max'
+            controllers = os.path.join(root, 'cgroup.subtree_control')
+        else:
+            self.base = os.path.join(root, 'memory', APP_NAME)
+            self.limit_file = 'memory.limit_in_bytes'
+            controllers = None
+        try:
+            if controllers is not None:
+                with open(controllers) as f:
+                    if 'memory' not in f.read().split():
+                        raise OSError(errno.ENOTSUP, 'memory controller not enabled',
+                                      controllers)
+            if not os.path.isdir(self.base):
+                os.mkdir(self.base, 0o755)
+            if controllers is not None:
+                _write(os.path.join(self.base, 'cgroup.subtree_control'), '+memory')
+        except (IOError, OSError) as err:
+            logger.warn('WARNING: Cannot limit command memory, no cgroup: %s', err)
+            self.base = None
+
+    def create(self):
+        '''
+        A new cgroup holding at most limit bytes, None if it can't be made
+        '''
+        if self.base is None:
+            return None
+        path = os.path.join(self.base, 'cmd-%d-%d' % (os.getpid(), next(self._names)))
+        try:
+            os.mkdir(path, 0o755)
+            _write(os.path.join(path, self.limit_file), str(self.limit))
+        except (IOError, OSError) as err:
+            logger.debug('Could not create cgroup %s: %s', path, err)
+            self.remove(path)
+            return None
+        return path
+
+    def remove(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                logger.debug('Could not remove cgroup %s: %s', path, err)
+
+
+class CommandSupervisor(object):
+    '''
+    Starts collection commands with a CPU nice level, an I/O scheduling
+    class and priority, and optionally in a memory cgroup of their own
+    Commands are started through nice, ionice and a shell joining the
+    cgroup, each exec'ing the next, so no Python code runs in the child
+    between fork and exec, which would not be safe from the collection
+    worker threads
+    '''
+    def __init__(self, nice=0, ionice_class=None, ionice_priority=None,
+                 memory_limit=None):
+        self.prefix = []
+        if nice:
+            self.prefix.extend(_usable('nice', ['-n', str(nice)], 'CPU priority'))
+        if ionice_class:
+            args = ['-c', IONICE_CLASSES[ionice_class]]
+            if ionice_class == 'best-effort' and ionice_priority is not None:
+                args.extend(['-n', str(ionice_priority)])
+            self.prefix.extend(_usable('ionice', args, 'I/O priority'))
+        self.cgroups = None
+        if memory_limit:
+            self.cgroups = MemoryCgroups(memory_limit)
+            if self.cgroups.base is None:
+                self.cgroups = None
+
+    @property
+    def active(self):
+        '''
+        Whether the supervisor changes how commands run at all
+        '''
+        return bool(self.prefix or self.cgroups)
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        The supervisor the command_* settings describe
+        '''
+        ionice_class = config.get(APP_NAME, 'command_ionice_class') or None
+        if ionice_class is not None and ionice_class not in IONICE_CLASSES:
+            logger.warn('WARNING: Invalid command_ionice_class %s, valid classes are %s',
+                        ionice_class, ', '.join(sorted(IONICE_CLASSES)))
+            ionice_class = None
+        try:
+            nice = config.getint(APP_NAME, 'command_nice')
+            ionice_priority = config.getint(APP_NAME, 'command_ionice_priority')
+            memory_limit = config.getint(APP_NAME, 'command_memory_limit')
+        except ValueError:
+            logger.warn('WARNING: Invalid command priority or memory limit, '
+                        'running commands unrestricted')
+            return cls()
+        return cls(nice, ionice_class, ionice_priority, memory_limit)
+
+    def popen(self, args, **kwargs):
+        '''
+        Popen args under the supervisor's limits
+        The cgroup of the process is in its cgroup attribute, to be
+        handed to release once it has been waited for
+        '''
+        args = self.prefix + args
+        cgroup = self.cgroups.create() if self.cgroups else None
+        if cgroup:
+            # a command the cgroup can't be joined for runs unrestricted
+            args = ['/bin/sh', '-c', JOIN_CGROUP, cgroup] + args
+        try:
+            proc = Popen(args, **kwargs)
+        except Exception:
+            self.release_cgroup(cgroup)
+            raise
+        proc.cgroup = cgroup
+        return proc
+
+    def release(self, proc):
+        self.release_cgroup(proc.cgroup)
+
+    def release_cgroup(self, cgroup):
+        if cgroup:
+            self.cgroups.remove(cgroup)
@@ -8,8 +8,13 @@ import logging
 import uuid
 import datetime
 import shlex
+import shutil
 from subprocess import Popen, PIPE, STDOUT
 from constants import InsightsConstants as constants
+from paths import EXPANDER
+
+# bytes copied at a time by copy_data_to_file
+COPY_SIZE = 1024 * 1024
 
 logger = logging.getLogger(constants.app_name)
 
@@ -177,21 +182,14 @@ def _expand_paths(path):
     """
     Expand wildcarded paths
     """
-    import re
-    dir_name = os.path.dirname(path)
-    paths = []
     logger.debug("Attempting to expand %s", path)
-    if os.path.isdir(dir_name):
-        files = os.listdir(dir_name)
-        match = os.path.basename(path)
-        for file_path in files:
-            if re.match(match, file_path):
-                expanded_path = os.path.join(dir_name, file_path)
-                paths.append(expanded_path)
-        logger.debug("Expanded paths %s", paths)
-        return paths
-    else:
+    entries = EXPANDER.expand(path)
+    if entries is None:
         logger.debug("Could not expand %s", path)
+        return
+    paths = [entry.path for entry in entries]
+    logger.debug("Expanded paths %s", paths)
+    return paths
 
 
 def write_lastupload_file():
@@ -243,6 +241,30 @@ def write_data_to_file(data, filepath):
         _file.write(data.encode('utf8'))
 
 
+def copy_data_to_file(src, filepath):
+    '''
+    Copy the bytes of a file object from its start to a file, in the
+    kernel where possible
+    '''
+    try:
+        os.makedirs(os.path.dirname(filepath), 0o700)
+    except OSError:
+        pass
+
+    with open(filepath, 'wb') as dest:
+        if hasattr(os, 'sendfile'):
+            src.flush()
+            offset = 0
+            while True:
+                sent = os.sendfile(dest.fileno(), src.fileno(), offset, COPY_SIZE)
+                if not sent:
+                    break
+                offset += sent
+        else:
+            src.seek(0)
+            shutil.copyfileobj(src, dest, COPY_SIZE)
+
+
 def magic_plan_b(filename):
     '''
     Use this in instances where
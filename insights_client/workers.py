@@ -0,0 +1,87 @@
+"""
+Bounded worker pool for running collection work concurrently
+"""
+import sys
+import threading
+import logging
+import six
+from six.moves import queue
+from constants import InsightsConstants as constants
+
+logger = logging.getLogger(constants.app_name)
+
+
+class _Result(object):
+    '''
+    Holds the outcome of a single work item until it is consumed
+    '''
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def set(self, value=None, exc_info=None):
+        self.value = value
+        self.exc_info = exc_info
+        self.event.set()
+
+    def get(self):
+        # wait in short slices so KeyboardInterrupt is still delivered
+        while not self.event.is_set():
+            self.event.wait(1)
+        if self.exc_info:
+            six.reraise(*self.exc_info)
+        return self.value
+
+
+class WorkerPool(object):
+    '''
+    Run a function over a list of items with at most `workers` threads.
+    Results are handed back in the order of the input items, regardless
+    of which worker finishes first.
+    '''
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+
+    def imap(self, func, items):
+        '''
+        Generator yielding func(item) for each item, in order.
+        Exceptions raised by func are re-raised in the calling thread
+        when the corresponding result is reached.
+        '''
+        items = list(items)
+        if self.workers == 1 or len(items) < 2:
+            for item in items:
+                yield func(item)
+            return
+
+        results = [_Result() for _ in items]
+        work = queue.Queue()
+        for i, item in enumerate(items):
+            work.put((i, item))
+        stopped = threading.Event()
+
+        def _worker():
+            while not stopped.is_set():
+                try:
+                    i, item = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[i].set(func(item))
+                except BaseException:
+                    results[i].set(exc_info=sys.exc_info())
+
+        num_threads = min(self.workers, len(items))
+        logger.debug('Starting %s collection workers', num_threads)
+        for _ in range(num_threads):
+            thread = threading.Thread(target=_worker)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for result in results:
+                yield result.get()
+        finally:
+            # consumer bailed out early, don't start any new work
+            stopped.set()
@@ -315,7 +315,7 @@ def test_compressor_option():
                                   stdout=subprocess.PIPE, shell=True)
     compressor_output, err = compressor.communicate()
     print compressor_output
-    compressor_regex = re.compile(r".*tar\.bzip2.*")
+    compressor_regex = re.compile(r".*tar\.bz2.*")
     if re.search(compressor_regex, compressor_output) is not None and \
             re.search("Upload completed successully!",
                       compressor_output) is None: